@@ -14,12 +14,18 @@ from helpers import *
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
 import os
+import codecs
 from zipfile import ZipFile
 from lxml import etree
 from collections import defaultdict
+from array import array
 from functools import partial
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 
 VM_url = {2016: 'https://www12.statcan.gc.ca/census-recensement/2016/dp-pd/dt-td/OpenDataDownload.cfm?PID=112451',
           2011: 'https://www12.statcan.gc.ca/nhs-enm/2011/dp-pd/dt-td/OpenDataDownload.cfm?PID=105395',
@@ -40,20 +46,8 @@ AI_table = {2016: '98-400-X2016155',
             2006: '97-558-XCB2006007',
             2001: '97F0011XCB2001002'}
 
-# The heuristic to remember the USA (standard) cohorts is C[0] is total population,
-# C[18] is 85+ population, and C[i] for 0 < i < 18 is P(5(i-1),5i)
-import re
-age_to_cohort = lambda age: 1+int(age)//5
-def get_cohorts(s):
-    x = re.findall('\d+', s) + [False, False]
-    a = age_to_cohort(x[0]) if x[0] else 0
-    b = (age_to_cohort(x[1]) if x[1] else 18) + 1
-    p = re.compile(r".*under.*?(\d+)", re.I)
-    y = re.match(p, s)
-    if y: a,b = 1, age_to_cohort(y.group(1))
-    return list(range(a, b))
 def CL_AGE_to_USA_age(CL_AGE):
-    available_cohorts = {k:get_cohorts(v) for k,v in CL_AGE.items()}
+    available_cohorts = {k:age_cohorts(v) for k,v in CL_AGE.items()}
     chosen_cohorts = {k:[] for k in CL_AGE}
     for usa_cohort in range(19):
         chosen = min([k for k,v in available_cohorts.items() if usa_cohort in v],
@@ -65,16 +59,30 @@ localname = lambda element: etree.QName(element).localname
 # It's bizarre to me that this is a necessary step to remove the specification
 # URL prefix from the tag name. Why the hell would I want to have the prefix
 # string-prepended to the localname when I use element.tag?
-childrendict = lambda element: {localname(child):child for child in element}
 get_tags = lambda element,tag: (el for el in element if localname(el) == tag)
 
 def parsezip(zipfn, fn, parsefunction, **kwargs):
-    with ZipFile(zipfn) as myzip:
-        return parsefunction( myzip.open(fn), **kwargs )
+    # the member is inflated in a background thread while it's being parsed
+    # (and the reader is stopped before the member is closed, even if parsing fails)
+    with ZipFile(zipfn) as myzip, myzip.open(fn) as file, closing(read_ahead(file)) as chunks:
+        return parsefunction( chunks, **kwargs )
 
-def get_records_from_xml(file, record_name):
-    for event, element in etree.iterparse(file):
-        if localname(element) != record_name: continue
+def get_records_from_xml(chunks, record_name):
+    # chunks of bytes are fed to a pull parser, which leaves the decoding to
+    # libxml2 (by the XML declaration); StatCan's files start with a UTF-8 BOM,
+    # which is dropped beforehand
+    parser = etree.XMLPullParser(events=('end',), tag='{*}'+record_name)
+    first = True
+    for data in chunks:
+        if first and data.startswith(codecs.BOM_UTF8): data = data[len(codecs.BOM_UTF8):]
+        first = False
+        parser.feed(data)
+        yield from records(parser)
+    parser.close()
+    yield from records(parser)
+
+def records(parser):
+    for event, element in parser.read_events():
         yield element
         if element.getparent() is not None: element.getparent().clear()
         # for reasons unbeknownst to me, sometimes the parent is None and
@@ -88,29 +96,43 @@ def parseStructure(file):
             Codes[CodeList.get('id')][Code.get('value')] = desc    
     return dict(Codes)
 
-@memoize
+@memoize(maxsize=16)
 def Codes(table):
-    return parsezip(f'{table}.ZIP', f'Structure_{table}.xml', parseStructure)
+    # the parsed code lists are kept next to the ZIP until the ZIP changes
+    parse = lambda: parsezip(root(table), f'Structure_{table}.xml', parseStructure)
+    return cached_json(f'{table}.codes.json', root(table), parse)
 
 def parseGeneric(file, seriesfunction):
-    columns = defaultdict(dict)
+    # Observations are streamed into typed buffers of interned codes instead
+    # of a dict of dicts keyed by tuples, and the frame is scattered at the end
+    geos, sexes, cols = Interned(), Interned(), Interned()
+    geo, age, sex, col, val = array('q'), array('q'), array('q'), array('q'), array('d')
     for Series in get_records_from_xml(file, 'Series'):
-        for idx, col, val in seriesfunction(Series):
-            columns[col][idx] = val    
-    df = pd.DataFrame.from_dict(columns)
-    df.index.rename( ("GEO", "AGE", "SEX"), inplace=True )
-    return df
+        for (g, a, s), c, v in seriesfunction(Series):
+            geo.append(geos[g]); age.append(a); sex.append(sexes[s])
+            col.append(cols[c]); val.append(v)
+    geo, age, sex, col = (np.frombuffer(x, dtype=np.int64) for x in (geo, age, sex, col))
+    
+    # rows are numbered in order of appearance, like the from_dict rows were
+    n_age = age.max()+1 if len(age) else 1
+    row_codes, rows = pd.factorize((geo*n_age + age)*len(sexes) + sex)
+    values = np.full((len(rows), len(cols)), np.nan)
+    values[row_codes, col] = np.frombuffer(val)
+    index = pd.MultiIndex(levels=[list(geos), range(n_age), list(sexes)],
+                          codes=[rows // len(sexes) // n_age, rows // len(sexes) % n_age, rows % len(sexes)],
+                          names=("GEO", "AGE", "SEX"))
+    return pd.DataFrame(values, index=index, columns=list(cols))
 
 def parseSeries(age_to_USA_age, condition, relevant_key, # first line of params will be partial'd
                 Series):
-    children = childrendict(Series)
-    key = {child.get("concept").upper():child.get("value") for child in children["SeriesKey"]}
-    obs = childrendict(children["Obs"])
+    # the schema puts SeriesKey first and the Obs last
+    key = {child.get("concept").upper():child.get("value") for child in Series[0]}
+    obs = next(child for child in Series[-1] if child.tag.endswith("ObsValue"))
     
     standardAges = age_to_USA_age[key["AGE"]]
     if condition(key) and standardAges:
         col, geo, sex = map(key.get, (relevant_key, "GEO", "SEX") )
-        val = float(obs["ObsValue"].get("value")) / len(standardAges) # population value
+        val = float(obs.get("value")) / len(standardAges) # population value
         for sAge in standardAges:
             idx = (geo, sAge, sex)
             yield idx, col, val
@@ -159,36 +181,62 @@ def parseVMtable(year):
 @clickwatch
 def porcess_geos():
     """porcessing aggregate geographies"""
+    index = vmaidf.index.remove_unused_levels()
+    geos, ages, sexes = index.levels
+    geo_codes, age_codes, sex_codes = index.codes
+    # (AGE, SEX) pairs are numbered in order of appearance, like the rows of a geo's dataframe
+    key_codes, keys = pd.factorize(age_codes.astype(np.intp) * len(sexes) + sex_codes)
+
+    # geo value block: geo x (AGE, SEX) x column, NaN where a geo lacks a row
+    values = vmaidf.to_numpy()
+    block = np.full((len(geos), len(keys), values.shape[1]), np.nan)
+    block[geo_codes, key_codes] = values
+
+    # The populations of `rural province` are computed by inclusion-exclusion
+    geos = pd.Index(geos)
+    prov, other = geos.str[:2], geos.str[-2:]
+    length = geos.str.len()
+    terms = [
+        # Include (this province) in (this rural province)
+        ((length == 2) & (geos != '01'), prov, 1, 0),
+        # exclude (whole CMA/CA which is primarily from this province) in (this rural province)
+        (length == 5, prov, -1, 0),
+        # include (iow negate the exclusion of) (part of CMA/CA from other province) in (this rural province)
+        ((length == 7) & (prov != other), prov, 1, 0),
+        # exclude (part of CMA/CA from other province) in (other rural province)
+        ((length == 7) & (prov != other), other, -1, 1)]
+    geo_idx = np.concatenate([np.flatnonzero(mask) for mask, _, _, _ in terms])
+    rurals = np.concatenate([np.asarray('R' + provs[mask], dtype=object) for mask, provs, _, _ in terms])
+    coeffs = np.concatenate([np.full(mask.sum(), coeff) for mask, _, coeff, _ in terms])
+    # rural provinces are numbered in the order the geos reach them, geos being visited sorted
+    rank = np.empty(len(geos), dtype=np.intp)
+    rank[geos.argsort()] = np.arange(len(geos))
+    order = np.argsort(rank[geo_idx] * 2 + np.concatenate([np.full(mask.sum(), k) for mask, _, _, k in terms]),
+                       kind='stable')
+    rural_codes, Rprovs = pd.factorize(rurals[order])
+
+    # every rural province is one signed row of a (rural province x geo) incidence matrix
+    incidence = sparse.csr_matrix((coeffs[order].astype(block.dtype), (rural_codes, geo_idx[order])),
+                                  shape=(len(Rprovs), len(geos)))
+    ruralvalues = incidence @ block.reshape(len(geos), -1)
+
     global Geocdfs
-    Geocdfs = dict() # Geo dataframe(s)
-    for idx, df in vmaidf.groupby(level=0):
-        df = df.loc[idx]
-        rurals = []
-        # The populations of `rural province` are computed by inclusion-exclusion
-        if len(idx) == 2:
-            # Include (this province) in (this rural province)
-            if idx != '01': rurals.append( (idx, 1) )
-        elif len(idx) == 5:
-            # exclude (whole CMA/CA which is primarily from this province) in (this rural province)
-            rurals.append( (idx[:2], -1) )
-        elif len(idx) == 7 and idx[:2] != idx[-2:]:
-            # include (iow negate the exclusion of) (part of CMA/CA from other province) in (this rural province)
-            rurals.append( (idx[:2], 1) )
-            # exclude (part of CMA/CA from other province) in (other rural province)
-            rurals.append( (idx[-2:], -1) )
-        for prov, coeff in rurals:
-            Rprov = 'R'+prov
-            cdf = coeff*df
-            Geocdfs[Rprov] = Geocdfs[Rprov]+cdf if Rprov in Geocdfs else cdf
+    Geocdfs = pd.DataFrame( # rural province dataframe
+        ruralvalues.reshape(len(Rprovs) * len(keys), -1),
+        index=pd.MultiIndex(levels=[Rprovs, ages, sexes],
+                            codes=[np.repeat(np.arange(len(Rprovs)), len(keys)),
+                                   np.tile(keys // len(sexes), len(Rprovs)),
+                                   np.tile(keys % len(sexes), len(Rprovs))],
+                            names=vmaidf.index.names),
+        columns=vmaidf.columns)
+    stage_rows(len(vmaidf))
 
 @clickwatch
 def append_geos():
     """appending aggregate geographies"""
-    for geo, df in Geocdfs.items():
-        df.index = pd.MultiIndex.from_tuples((geo,)+idx for idx in df.index)
-    
     global Geocdf
-    Geocdf = vmaidf.append(list(Geocdfs.values()))
+    Geocdf = append_frame(vmaidf, Geocdfs)
+    stage_rows(len(Geocdf))
 
 @clickwatch
 def add_myrace_columns():
@@ -205,29 +253,22 @@ def add_myrace_columns():
     
     global my_races
     my_races = ['E', 'W', 'B', 'R', 'Y', 'N']
-    for idx, val in coeff.iteritems():
-        if val not in [-np.inf, np.nan, np.inf]: continue
-        replace_value = Geocdf['1'][idx] / 5
-        for race in my_races:
-            Geocdf[race][idx] = replace_value
+    # where the coefficient is undefined every race gets a fifth of the total instead
+    valid = np.isfinite(coeff)
+    fallback = Geocdf['1'] / 5
+    for race in my_races: Geocdf[race] = Geocdf[race].where(valid, fallback)
+    stage_rows(len(Geocdf))
 
 @clickwatch
 def porcess_data():
     """calculating CRR and ACE"""
-    relevant = Geocdf[my_races].groupby("SEX").get_group("3").reset_index().set_index("GEO")
-    relevant = relevant.drop(["SEX"], axis=1).drop([idx for idx in relevant.index if len(idx) == 7])
-    
-    relevant_groups = relevant.groupby("AGE")
-    mygroup = lambda i: relevant_groups.get_group(i).drop("AGE", axis=1)
-    daughters, bottom, top = (mygroup(i) for i in (1,4,10))
-    mothers = sum(mygroup(i) for i in range(5,10)) + (bottom+top)/2
-    
-    crr = (daughters*6 / mothers).round(2).rename(columns=lambda x: x[0]+'_CRR')
-    crr = replace_inf(crr)
-    ace = ((daughters-top)/5).round(0).astype(int).rename(columns=lambda x: x[0]+'_ACE')
+    relevant = Geocdf[my_races].xs("3", level="SEX")
+    relevant = relevant[relevant.index.get_level_values("GEO").str.len() != 7]
+    pop, geos = cohort_array(relevant.droplevel("AGE"), relevant.index.get_level_values("AGE"))
     
     global alldata
-    alldata = pd.concat([crr, ace], axis=1)
+    alldata = crr_ace_frame(pop, geos, my_races)
+    stage_rows(len(relevant))
     # crr = crude reproduction rate, an approximation of the net reproduction rate
     # ace = annual cohort exchange
 
@@ -235,21 +276,64 @@ def porcess_data():
 def write_data(year):
     """writing tsvs"""
     ensure_dir('DATA')
+    stage_rows(len(alldata))
     alldata.to_csv(f'DATA{os.sep}{year}.tsv', sep='\t')
+    outputs = [f'DATA{os.sep}{year}.tsv']
+    if output_settings['parquet']:
+        outputs += write_parquet(alldata, None, lambda _: {'country': 'canada', 'year': year})
+    return outputs
 
-def main2(year):
-    get_file(root(AI_table[year]), AI_url[year])
-    get_file(root(VM_table[year]), VM_url[year])
+def main2(year, aidf, vmdf):
     print(f"processing data for {year}")
-    aidf = parseAItable(year)
-    vmdf = parseVMtable(year)
     global vmaidf
     vmaidf = pd.concat([vmdf, aidf[['1','2']].rename(columns={'1':'E','2':'A'})], axis=1)
-    porcess_geos()
-    append_geos()
-    add_myrace_columns()
-    porcess_data()
-    write_data(year)
-
-for year in [2001, 2006, 2011, 2016]:
-    main2(year)
\ No newline at end of file
+    with stage_context(country='canada', year=year):
+        porcess_geos()
+        append_geos()
+        add_myrace_columns()
+        porcess_data()
+        return write_data(year)
+
+def sources(years):
+    '''(path, url) of every table the years need'''
+    return [(root(table[year]), url[year]) for year in years
+            for table, url in ((AI_table, AI_url), (VM_table, VM_url))]
+
+def main(years=(2001, 2006, 2011, 2016), workers=None, force=False):
+    get_files(sources(years))
+    # a year's tsv only depends on its two tables and this code
+    manifest = Manifest()
+    code = code_version(__file__)
+    dependencies = {year: manifest.dependencies([root(AI_table[year]), root(VM_table[year])], code=code,
+                                                 parquet=output_settings['parquet'])
+                    for year in years}
+    stale = [year for year in years if force or not manifest.fresh(f'canada {year}', dependencies[year])]
+    for year in years:
+        if year not in stale: print(f"canada {year} is up to date")
+    outputs = {}
+    with stage_context(country='canada'):
+        if workers == 1:
+            for year in stale:
+                outputs[year] = main2(year, parseAItable(year), parseVMtable(year))
+                manifest.record(f'canada {year}', dependencies[year], outputs[year])
+        else:
+            # The AI and VM tables of every year are independent and CPU-bound in lxml,
+            # so they are all parsed at once in a process pool and joined per year
+            with ProcessPoolExecutor(workers) as pool:
+                tables = {(year, parse): pool.submit(parse, year)
+                          for year in stale for parse in (parseAItable, parseVMtable)}
+                for year in stale:
+                    outputs[year] = main2(year, tables[year, parseAItable].result(), tables[year, parseVMtable].result())
+                    manifest.record(f'canada {year}', dependencies[year], outputs[year])
+    return [path for year in stale for path in outputs[year]]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of table-parsing processes (1 parses serially)')
+    parser.add_argument('--force', action='store_true', help='rebuild every year, even if its tables are unchanged')
+    parser.add_argument('--parquet', help='also write to this parquet dataset, partitioned by country and year')
+    args = parser.parse_args()
+    if args.parquet: parquet_to(args.parquet)
+    main(workers=args.workers, force=args.force)
+    if profile_settings['path']: profile_summary()
@@ -15,26 +15,99 @@ select all age groups except under 15 years, 15-29 years, 30-64 years, or 65 yea
 """
 
 from dtr4_categories import *
+import dtr4_categories
 import sys
 sys.path.append('..')
 from helpers import *
 import pandas as pd
-from collections import defaultdict
+import numpy as np
+from scipy import sparse
+import argparse
+import gzip
+from zipfile import ZipFile, is_zipfile
+from contextlib import contextmanager
 
 # Responses must be normalized before they are partitioned because folk are allowed
 # to give zero or one or more ethnicity responses
 # Response categories are normalized to the group response totals and then again
 # normalized to the population total
 
+# the export as nzdotstat delivers it: named .gz, but a ZIP holding a data and a footnotes csv
+dtr4path = ('Ethnic group (detailed total response - level 4), by age group and sex, for the census usually '
+            'resident population count, 2006, 2013, and 2018 Censuses (RC, TA, DHB).gz')
+dtr4cache = 'DTR4_2018.npz'
+
+@contextmanager
+def open_dtr4(path):
+    if is_zipfile(path):
+        with ZipFile(path) as myzip:
+            with myzip.open(next(fn for fn in myzip.namelist() if '_Data_' in fn)) as file: yield file
+    elif path.endswith('.gz'):
+        with gzip.open(path) as file: yield file
+    else:
+        with open(path, 'rb') as file: yield file
+
 @clickwatch
 def load_dtr4df():
     '''loading dtr4 dataframe'''
+    # The parsed dataframe is cached next to the export, keyed by the export's
+    # hash, so only the first run decompresses and parses the text
     global dtr4df
-    dtr4df = pd.read_table('DTR4_2018.csv', index_col=[0,1,2,3,4])
-    v_name = "Value  Flags"
-    dtr4df[v_name] = pd.to_numeric(dtr4df[v_name], errors='coerce').fillna(0)
-    dtr4df = dtr4df.loc[~dtr4df.index.duplicated()][v_name].unstack()
-    dtr4df.index.rename( ("GEO", "YEAR", "SEX", "AGE"), inplace=True)
+    key = file_digest(dtr4path)
+    dtr4df = load_frame(dtr4cache, key)
+    if dtr4df is None:
+        dtr4df = read_dtr4(dtr4path)
+        save_frame(dtr4cache, dtr4df, key)
+    stage_rows(len(dtr4df))
+
+def read_dtr4(path):
+    # The export is streamed twice in chunks with categorical columns: once for
+    # the labels, then to scatter the values into a float32 (row x ethnic group)
+    # grid of exactly the final size, its rows already in the sorted order the
+    # unstack gave them. Missing cells stay NaN and only the first of
+    # duplicated cells is kept, like the unstack used to do.
+    index_names = ("GEO", "YEAR", "SEX", "AGE")
+    read = lambda file, **kwargs: pd.read_table(file, dtype='category', chunksize=1 << 12, **kwargs)
+    seen = [set() for _ in index_names]
+    ethnic_groups = Interned()
+    for eth in all_ethnic_groups: ethnic_groups[eth] # Maori is listed twice
+    with open_dtr4(path) as file:
+        for chunk in read(file, usecols=range(5)):
+            for col, labels in zip(chunk.columns, seen): labels.update(chunk[col].cat.categories)
+            eth = chunk.iloc[:, 4].array # new groups in order of appearance
+            for e in eth.categories[pd.unique(eth.codes)]: ethnic_groups[e]
+    
+    levels = [pd.Index(sorted(labels, key=int if name == "YEAR" else None))
+              for name, labels in zip(index_names, seen)]
+    positions = [{label: i for i, label in enumerate(level)} for level in levels] + [ethnic_groups]
+    levels[1] = levels[1].astype(int)
+    shape = tuple(map(len, levels))
+    grid = np.full((np.prod(shape), len(ethnic_groups)), np.nan, dtype=np.float32)
+    cells = grid.reshape(-1)
+    with open_dtr4(path) as file:
+        for chunk in read(file):
+            at = []
+            for col, position in zip(chunk.columns[:5], positions):
+                labels = chunk[col].array
+                at.append(np.array([position[c] for c in labels.categories], dtype=np.intp)[labels.codes])
+            flat = np.ravel_multi_index(at[:4], shape) * grid.shape[1] + at[4]
+            _, first = np.unique(flat, return_index=True)
+            first = first[np.isnan(cells[flat[first]])]
+            values = chunk.iloc[:, 5].array
+            # every distinct value is parsed once; the 0 at the end is for empty cells (code -1)
+            numbers = np.append(pd.to_numeric(values.categories, errors='coerce').fillna(0), 0).astype(np.float32)
+            cells[flat[first]] = numbers[values.codes[first]]
+    del cells
+    
+    # rows without any value are dropped by moving the others up in place
+    present = np.flatnonzero(~np.isnan(grid).all(axis=1))
+    if len(present) < len(grid):
+        for start in range(0, len(present), 1 << 12):
+            rows = present[start:start + (1 << 12)]
+            grid[start:start+len(rows)] = grid[rows]
+        grid.resize((len(present), grid.shape[1]), refcheck=False)
+    index = pd.MultiIndex.from_product(levels, names=index_names)[present]
+    return pd.DataFrame(grid, index=index, columns=list(ethnic_groups), copy=False)
 
 @clickwatch
 def sanity_check():
@@ -47,56 +120,83 @@ def sanity_check():
         if right: print(' '.join(right), 'not in stored categories')
         if left or right: raise ValueError("dataframe columns don't match stored categories")
 
+def compile_levels(columns, levels):
+    '''
+    index arrays for normalizing every (level, sublevels) pair of levels at
+    once: the level columns, a (level x column) matrix summing the specified
+    subgroups of each level in order, and every sublevel column with its level
+    '''
+    position = {c: i for i, c in enumerate(columns)}
+    parents, indptr, summed, children, child_levels = [], [0], [], [], []
+    for i, (level_name, sublevel_names) in enumerate(levels):
+        parents.append(position[level_name])
+        summed += [position[s] for s in sublevel_names if s not in unspecified_groups]
+        indptr.append(len(summed))
+        children += [position[s] for s in sublevel_names]
+        child_levels += [i] * len(sublevel_names)
+    membership = sparse.csr_matrix((np.ones(len(summed), dtype=np.float32), summed, indptr),
+                                   shape=(len(levels), len(columns)))
+    return np.array(parents), membership, np.array(children), np.array(child_levels)
+
 @clickwatch
 def normalize_columns():
     '''normalizing columns'''
-    def normalize_level(level_name, sublevel_names):
-        subgroups = [s for s in sublevel_names if s not in unspecified_groups]
-        total_column = sum(dtr4df[s] for s in subgroups)
-        ratio_column = replace_inf(dtr4df[level_name] / total_column)
-        for s in sublevel_names: dtr4df[s] *= ratio_column
-    normalize_level(total_people_name, total_people_sublevels)
-    for k,v in total_people_dict.items():
-        if k not in unspecified_groups: normalize_level(k, v)
+    global dtr4df
+    values = dtr4df.to_numpy(dtype=np.float32, copy=True)
+    def normalize_levels(levels):
+        parents, membership, children, child_levels = compile_levels(dtr4df.columns, levels)
+        totals = (membership @ values.T).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = values[:, parents] / totals
+        ratios[~np.isfinite(ratios)] = 0
+        values[:, children] *= ratios[:, child_levels]
+    normalize_levels([(total_people_name, total_people_sublevels)])
+    normalize_levels([(k, v) for k, v in total_people_dict.items() if k not in unspecified_groups])
+    dtr4df = pd.DataFrame(values, index=dtr4df.index, columns=dtr4df.columns, copy=False)
+    stage_rows(len(dtr4df))
+
+@memoize(maxsize=None)
+def race_weights(columns, races, ethnicity_races):
+    '''
+    (column x race) weight matrix: E is the total column, and an ethnicity
+    counted in n races (e.g. 'WY') adds 1/n of itself to each of them
+    '''
+    position = {c: i for i, c in enumerate(columns)}
+    weights = np.zeros((len(columns), len(races)), dtype=np.float32)
+    weights[position[total_people_name], races.index('E')] = 1
+    for eth, eth_races in ethnicity_races:
+        for r in eth_races:
+            if r in races: weights[position[eth], races.index(r)] += 1 / len(eth_races)
+    return weights
 
 @clickwatch
 def add_myrace_columns():
     '''adding myrace columns'''
-    dtr4df['E'] = dtr4df[total_people_name]
-    ethnicities_in_race = defaultdict(set)
-    for eth in race_counted_groups:
-        races = Ethnicity_to_race[eth]
-        weight = 1 / len(races)
-        for r in races: ethnicities_in_race[r].add( (eth, weight) )
-    global my_races
+    global dtr4df, my_races
     my_races = ['E','W','B','R','Y','N','Z']
-    for r in my_races[1:]:
-        dtr4df[r] = sum(dtr4df[eth]*weight for eth,weight in ethnicities_in_race[r])
+    # the matrix is keyed by everything it's compiled from, so it's only built once per process
+    weights = race_weights(tuple(dtr4df.columns), tuple(my_races),
+                           tuple(sorted((eth, Ethnicity_to_race[eth]) for eth in race_counted_groups)))
+    values = dtr4df.to_numpy(dtype=np.float32)
+    missing = np.isnan(values)
+    # a missing cell only makes the races it counts in missing, like the column
+    # sums used to, instead of spreading to the whole row through the product
+    races = np.where(missing, 0, values) @ weights
+    races[missing @ (weights != 0)] = np.nan
+    races = pd.DataFrame(races, index=dtr4df.index, columns=my_races)
+    dtr4df = pd.concat([dtr4df, races], axis=1)
+    stage_rows(len(dtr4df))
 
 @clickwatch
 def porcess_data():
     """calculating CRR and ACE"""
-    import re
-    def get_cohort(s):
-        x = re.search('\d+', s)
-        if not x: return 0
-        else: return 1+int(x.group(0))//5
-        
-    relevant = dtr4df[my_races].groupby("SEX").get_group("Female").reset_index().set_index(["GEO", "YEAR"])
-    relevant.drop(["SEX"], axis=1, inplace=True)
-    relevant["AGE"] = relevant["AGE"].apply(get_cohort)
-    
-    relevant_groups = relevant.groupby("AGE")
-    mygroup = lambda i: relevant_groups.get_group(i).drop("AGE", axis=1)
-    daughters, bottom, top = (mygroup(i) for i in (1,4,10))
-    mothers = sum(mygroup(i) for i in range(5,10)) + (bottom+top)/2
-    
-    crr = (daughters*6 / mothers).round(2).rename(columns=lambda x: x[0]+'_CRR')
-    crr = replace_inf(crr)
-    ace = ((daughters-top)/5).round(0).astype(int).rename(columns=lambda x: x[0]+'_ACE')
+    relevant = dtr4df[my_races].xs("Female", level="SEX")
+    cohorts = cohort_codes(relevant.index.get_level_values("AGE"))
+    pop, keys = cohort_array(relevant.droplevel("AGE"), cohorts)
     
     global alldata
-    alldata = pd.concat([crr, ace], axis=1)
+    alldata = crr_ace_frame(pop, keys, my_races)
+    stage_rows(len(relevant))
     # crr = crude reproduction rate, an approximation of the net reproduction rate
     # ace = annual cohort exchange
 
@@ -104,17 +204,39 @@ def porcess_data():
 def write_data():
     """writing tsvs"""
     ensure_dir('DATA')
-    for year, data in alldata.groupby(level=1):
-        data = data.reset_index().set_index("GEO").drop("YEAR", axis=1)
-        data.to_csv(f'DATA{os.sep}{year}.tsv', sep='\t')
-
-def main():
-    load_dtr4df()
-    sanity_check()
-    normalize_columns()
-    add_myrace_columns()
-    porcess_data()
-    write_data()
+    stage_rows(len(alldata))
+    outputs = write_tsvs(alldata, "YEAR", lambda year: f'DATA{os.sep}{year}.tsv')
+    if output_settings['parquet']:
+        outputs += write_parquet(alldata, "YEAR", lambda year: {'country': 'nz', 'year': year})
+    return outputs
+
+def sources(years):
+    '''the export ships with this script, nothing is downloaded'''
+    return []
+
+def main(force=False):
+    # every census year comes out of the one export, so they're rebuilt together
+    manifest = Manifest()
+    dependencies = manifest.dependencies([dtr4path], code=code_version(__file__, dtr4_categories.__file__),
+                                         parquet=output_settings['parquet'])
+    if not force and manifest.fresh('nz', dependencies):
+        print("nz is up to date")
+        return
+    with stage_context(country='nz'):
+        load_dtr4df()
+        sanity_check()
+        normalize_columns()
+        add_myrace_columns()
+        porcess_data()
+        outputs = write_data()
+    manifest.record('nz', dependencies, outputs)
+    return outputs
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='rebuild even if the export is unchanged')
+    parser.add_argument('--parquet', help='also write to this parquet dataset, partitioned by country and year')
+    args = parser.parse_args()
+    if args.parquet: parquet_to(args.parquet)
+    main(force=args.force)
+    if profile_settings['path']: profile_summary()
@@ -10,41 +10,45 @@ from helpers import *
 import glob
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from itertools import product
 from collections import defaultdict
 import os
+import argparse
 
 dir2000 = 'cc-est2010'
 fn2000  = 'cc-est2010-alldata.csv'
+url2000 = 'https://www2.census.gov/programs-surveys/popest/datasets/2010/2010-eval-estimates/' + fn2000
 dir2010 = 'cc-est2019'
 fn2010  = 'cc-est2019-alldata.csv'
-def download_datasets():
-    if decade == 2000:
-        url = 'https://www2.census.gov/programs-surveys/popest/datasets/2010/2010-eval-estimates/' + fn2000
-        os.makedirs(dir2000, exist_ok=True)
-        path = dir2000 + os.sep + fn2000
-        get_file(path, url)
-    if decade == 2010:    
-        url = 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/asrh/' + fn2010
-        os.makedirs(dir2010, exist_ok=True)
-        path = dir2010 + os.sep + fn2010
-        get_file(path, url)
+url2010 = 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/asrh/' + fn2010
+PSApath = 'list1_2020.xls'
+PSAurl  = 'https://www2.census.gov/programs-surveys/metro-micro/geographies/reference-files/2020/delineation-files/' + PSApath
+ccest_paths = {2000: dir2000 + os.sep + fn2000, 2010: dir2010 + os.sep + fn2010}
+def sources(decades):
+    '''(path, url) of every source file the decades need'''
+    urls = {2000: url2000, 2010: url2010}
+    return [(PSApath, PSAurl)] + [(ccest_paths[decade], urls[decade]) for decade in decades]
+
+def download_datasets(decades):
+    # every missing source file is fetched at once
+    for decade in decades: os.makedirs(os.path.dirname(ccest_paths[decade]), exist_ok=True)
+    get_files(sources(decades))
 
 ##############################################################################################################################################################
 @clickwatch
 def load_PSAdf():
     """loading PSA dataframe"""
     # Primary Statistical Area dataframe
-    path = 'list1_2020.xls'
-    url = 'https://www2.census.gov/programs-surveys/metro-micro/geographies/reference-files/2020/delineation-files/' + path
-    get_file(path, url)
+    get_file(PSApath, PSAurl)
     global PSAdf
-    PSAdf = pd.read_excel(path, skiprows=2, nrows=1916, dtype=str)
+    PSAdf = pd.read_excel(PSApath, skiprows=2, nrows=1916, dtype=str)
     # Delinations source file originally hosted at:
     # https://www2.census.gov/programs-surveys/metro-micro/geographies/reference-files/2020/delineation-files/list1_2020.xls
     # https://www.census.gov/geographies/reference-files/time-series/demo/metro-micro/delineation-files.html
     # https://www.census.gov/programs-surveys/metro-micro.html
     PSAdf.set_index(PSAdf['FIPS State Code'] + PSAdf['FIPS County Code'], inplace=True)
+    stage_rows(len(PSAdf))
 ##############################################################################################################################################################
 
 ##############################################################################################################################################################
@@ -57,59 +61,103 @@ def load_ccest():
     # https://www.census.gov/data/tables/time-series/demo/popest/2010s-counties-detail.html
     
     # ccdf = county characteristics dataframe
-    ignored_cols = ['SUMLEV', 'STNAME', 'CTYNAME']
     global ccdf
-    if decade == 2010: path = dir2010 + os.sep + fn2010
-    if decade == 2000: path = dir2000 + os.sep + fn2000
-    with open(path) as f: header = f.readline().split(',')
-    dtype = {"STATE": str, "COUNTY": str}
-    ccdf = pd.read_csv(path, encoding = "ISO-8859-1",
-                        usecols=lambda x: x not in ignored_cols,
-                        dtype=dtype)
-    ccdf.fillna(0,inplace=True)
-    if decade == 2000:
-        ccdf['STATE'] = ccdf['STATE'].apply(lambda x: x.zfill(2))
-        ccdf['COUNTY'] = ccdf['COUNTY'].apply(lambda x: x.zfill(3))
-    ccdf["GEO"] = ccdf["STATE"] + ccdf["COUNTY"]
-    ccdf.drop(["STATE", "COUNTY"], axis=1, inplace=True)
-    ccdf.set_index(["GEO", "YEAR", "AGEGRP"], inplace=True)
-    
+    path = ccest_paths[decade]
+    # the parsed dataframe is cached next to the csv and reused for as long as
+    # the csv keeps the same size and modification time
+    cachepath = os.path.splitext(path)[0] + '.npz'
+    key = file_stamp(path)
+    mmap = bool(storage_settings['memmap'])
+    ccdf = load_frame(cachepath, key, mmap)
+    if ccdf is None:
+        ccdf = read_ccest(path)
+        save_frame(cachepath, ccdf, key)
+        if mmap: ccdf = load_frame(cachepath, key, mmap) # the parsed copy is dropped for the mapped one
+    stage_rows(len(ccdf))
+
+def read_ccest(path):
+    ignored_cols = ['SUMLEV', 'STNAME', 'CTYNAME']
+    index_cols = ['STATE', 'COUNTY', 'YEAR', 'AGEGRP']
+    with open(path, encoding = "ISO-8859-1") as f: header = f.readline().strip().split(',')
+    value_cols = [c for c in header if c not in ignored_cols + index_cols]
+    dtype = {'STATE': np.int8, 'COUNTY': np.int16, 'YEAR': np.int8, 'AGEGRP': np.int8}
+    read = lambda value_dtype: pd.read_csv(path, encoding = "ISO-8859-1",
+                                           usecols=index_cols + value_cols,
+                                           dtype=dtype | dict.fromkeys(value_cols, value_dtype))
+    try:
+        df = read(np.int32)
+    except ValueError: # missing values, which are filled with 0
+        df = read(np.float64)
+
+    # the 2000s file doesn't zero-pad its FIPS codes, so GEO is built from the
+    # integer codes and only the distinct counties are formatted as strings
+    fips = df['STATE'].to_numpy(np.int32) * 1000 + df['COUNTY'].to_numpy(np.int32)
+    geo_codes, counties = pd.factorize(fips, sort=True)
+    year_codes, years = pd.factorize(df['YEAR'], sort=True)
+    agegrp_codes, agegrps = pd.factorize(df['AGEGRP'], sort=True)
+    index = pd.MultiIndex(levels=[pd.Index(counties).astype(str).str.zfill(5), years, agegrps],
+                          codes=[geo_codes, year_codes, agegrp_codes],
+                          names=["GEO", "YEAR", "AGEGRP"])
+    values = df[value_cols].fillna(0).to_numpy(np.int32)
+    return pd.DataFrame(values, index=index, columns=value_cols, copy=False)
+
 ##############################################################################################################################################################
 
 ##############################################################################################################################################################
 @clickwatch
 def porcess_geos():
     """porcessing aggregate geographies"""
+    index = ccdf.index.remove_unused_levels()
+    counties, years, agegrps = index.levels
+    county_codes, year_codes, agegrp_codes = index.codes
+    # (YEAR, AGEGRP) pairs are numbered in order of appearance, same as the rows
+    # of the first county's dataframe used to be
+    key_codes, keys = pd.factorize(year_codes.astype(np.intp) * len(agegrps) + agegrp_codes)
+
+    # county value block: county x (YEAR, AGEGRP) x column
+    values = ccdf.to_numpy()
+    block = value_block(f'usa-{decade}-counties', (len(counties), len(keys), values.shape[1]), values.dtype)
+    block[county_codes, key_codes] = values
+
+    PSA = PSAdf.reindex(counties)
+    members = np.empty((len(counties), 4), dtype=object)
+    members[:,0] = '0' # nation
+    members[:,1] = counties.str[:2] # state
+    members[:,2] = 'M' + PSA['CBSA Code'] # Core-based Statistical Area
+    members[:,3] = PSA['CSA Code'].dropna().map(lambda x: 'P' + str(int(x))).reindex(counties)
+    # Primary Statistical Areas include Combined Statistical Areas (CSAs)
+    # and the Core-Based Statistical Areas (CBSAs) that aren't in a CSA
+
+    # Aggregate geographies are numbered in the order the counties first reach
+    # them, and every county contributes once to each geography it belongs to,
+    # so the whole stage is one (geo x county) incidence matrix product
+    members = members.ravel()
+    member_of = pd.notna(members)
+    geo_codes, geos = pd.factorize(members[member_of])
+    county_idx = np.repeat(np.arange(len(counties)), 4)[member_of]
+    incidence = sparse.csr_matrix((np.ones(len(geo_codes), dtype=block.dtype), (geo_codes, county_idx)),
+                                  shape=(len(geos), len(counties)))
+    geovalues = incidence @ block.reshape(len(counties), -1)
+
     global Geocdfs
-    Geocdfs = dict() # Geo characteristics dataframe(s)
-    for idx, df in ccdf.groupby(level=0): # is this the only way to loop through the top index?
-        df = df.loc[idx]
-        ste = idx[:2]
-        FIPS = idx
-        Geos = ['0', ste] # [state, nation]
-        if FIPS in PSAdf.index:
-            CBSACode = PSAdf['CBSA Code'][FIPS]
-            Geos.append('M' + CBSACode) # Core-based Statistical Area
-            CSACode = PSAdf['CSA Code'][FIPS]
-            if str(CSACode) != str(np.nan): Geos.append('P' + str(int(CSACode)))
-            # Primary Statistical Areas include Combined Statistical Areas (CSAs)
-            # and the Core-Based Statistical Areas (CBSAs) that aren't in a CSA
-        for g in Geos:
-            if g in Geocdfs:
-                Geocdfs[g] += df
-            else:
-                Geocdfs[g] = df.copy() # the .copy() fixed some weird errors for me
+    Geocdfs = pd.DataFrame( # Geo characteristics dataframe
+        geovalues.reshape(len(geos) * len(keys), -1),
+        index=pd.MultiIndex(levels=[geos, years, agegrps],
+                            codes=[np.repeat(np.arange(len(geos)), len(keys)),
+                                   np.tile(keys // len(agegrps), len(geos)),
+                                   np.tile(keys % len(agegrps), len(geos))],
+                            names=ccdf.index.names),
+        columns=ccdf.columns).astype(ccdf.dtypes)
+    stage_rows(len(ccdf))
 ##############################################################################################################################################################
 
 ##############################################################################################################################################################
 @clickwatch
 def append_geos():
     """appending aggregate geographies"""
-    for geo, df in Geocdfs.items():
-        df.index = pd.MultiIndex.from_tuples((geo,)+idx for idx in df.index)
-    
     global Geocdf
-    Geocdf = ccdf.append(list(Geocdfs.values())) # DataFrame reshapes take a long time so it's import to only do it once
+    Geocdf = append_frame(ccdf, Geocdfs, f'usa-{decade}-Geocdf') # DataFrame reshapes take a long time so it's import to only do it once
+    stage_rows(len(Geocdf))
 ##############################################################################################################################################################
 
 ##############################################################################################################################################################
@@ -134,28 +182,12 @@ def add_myrace_columns():
     """
     
     
-    for his, crace, sex in product(hispanic_status, census_races, sexes):
-        ph = his + crace + '%s' + sex # placeholder
-        Geocdf[ph%'C'] = Geocdf[ph%'AC'] - Geocdf[ph%'A']
-        # (in combination) = (alone or in combination) - (alone)
-        
-    for his, sex in product(hispanic_status, sexes):
-        ph = his + '%s' + sex # placeholder
-        Geocdf[ph%'TC'] = sum(Geocdf[ph%(crace+'C')] for crace in census_races)
-        # (total in combination) = (sum of [(crace in combination) for crace in census_races])
-        Geocdf[ph%'addterm'] = replace_inf(Geocdf[ph%'TOM'] / Geocdf[ph%'TC'])
-    
-    for his, crace, sex in product(hispanic_status, census_races, sexes):
-        ph = his + crace + '%s' + sex # placeholder
-        Geocdf[ph%'T'] = Geocdf[ph%'A'] + (Geocdf[ph%'C'] * Geocdf[his + 'addterm' + sex])
-    """
-    The people who are labeled `two or more races` (TOM) are partitioned into the
-    five census races in proportion to the frequency at which someone reports being
-    a given race "in combination" with additional race(s) (relative to the frequency
-    at which someone reports being any race "in combination" with additional races(s)).
-    """
-    
-    global my_races
+    # Every new column is computed on (row x hispanic x census race x sex) views
+    # of a single array which is attached to Geocdf in one concat
+    # (inserting the columns one at a time fragments the dataframe).
+    # Rows are done a chunk at a time, so that the float copies of the columns
+    # read from Geocdf's value block stay small.
+    global Geocdf, my_races
     my_races = {
         'E': ["TOT"],
         'W': ["NHWT"],
@@ -166,8 +198,54 @@ def add_myrace_columns():
     # everyone, white, black, red, yellow
     # See above commentary on whites, white hispanics (Mestizos), and Amerindians.
     
-    for (race,desig), sex in product(my_races.items(), sexes):
-        Geocdf[race+sex] = sum(Geocdf[desc+sex] for desc in desig)
+    cols = lambda s: [his + crace + s + sex for his, crace, sex in product(hispanic_status, census_races, sexes)]
+    position = Geocdf.columns.get_indexer
+    A_cols, AC_cols = position(cols('A')), position(cols('AC'))
+    TOM_cols = position([his + 'TOM' + sex for his, sex in product(hispanic_status, sexes)])
+    TOT_cols = position(['TOT' + sex for sex in sexes])
+    values = Geocdf.to_numpy() # a view of the value block
+    N, H, R, S = len(Geocdf), len(hispanic_status), len(census_races), len(sexes)
+    
+    names = (cols('C')
+             + [his + s + sex for his, sex in product(hispanic_status, sexes) for s in ('TC', 'addterm')]
+             + cols('T')
+             + [race + sex for race, sex in product(my_races, sexes)])
+    new = value_block(f'usa-{decade}-races', (N, len(names)), np.float64)
+    chunk = 1 << 16
+    for start in range(0, N, chunk):
+        rows = values[start:start+chunk]
+        n = len(rows)
+        A = rows[:, A_cols].astype(np.float64).reshape(n, H, R, S)
+        AC = rows[:, AC_cols].astype(np.float64).reshape(n, H, R, S)
+        TOM = rows[:, TOM_cols].astype(np.float64).reshape(n, H, S)
+        
+        C, totals, T, races = np.split(new[start:start+chunk], np.cumsum([H*R*S, H*S*2, H*R*S]), axis=1)
+        C, T = C.reshape(n, H, R, S), T.reshape(n, H, R, S)
+        TC, addterm = np.moveaxis(totals.reshape(n, H, S, 2), -1, 0)
+        
+        np.subtract(AC, A, out=C)
+        # (in combination) = (alone or in combination) - (alone)
+        np.sum(C, axis=2, out=TC)
+        # (total in combination) = (sum of [(crace in combination) for crace in census_races])
+        np.divide(TOM, TC, out=addterm, where=TC!=0) # the rest stay 0, like replace_inf
+        np.multiply(C, addterm[:, :, None, :], out=T)
+        T += A
+        """
+        The people who are labeled `two or more races` (TOM) are partitioned into the
+        five census races in proportion to the frequency at which someone reports being
+        a given race "in combination" with additional race(s) (relative to the frequency
+        at which someone reports being any race "in combination" with additional races(s)).
+        """
+        
+        desigs = {his + crace + 'T': T[:, i, j] for (i, his), (j, crace)
+                  in product(enumerate(hispanic_status), enumerate(census_races))}
+        desigs['TOT'] = rows[:, TOT_cols].astype(np.float64)
+        races = races.reshape(n, len(my_races), S)
+        for k, desig in enumerate(my_races.values()):
+            races[:, k] = sum(desigs[desc] for desc in desig)
+    
+    Geocdf = pd.concat([Geocdf, pd.DataFrame(new, index=Geocdf.index, columns=names, copy=False)], axis=1)
+    stage_rows(len(Geocdf))
     
 ##############################################################################################################################################################
 
@@ -177,18 +255,12 @@ def add_myrace_columns():
 def porcess_data():
     """calculating CRR and ACE"""
        
-    relevant = Geocdf[[race+"_FEMALE" for race in my_races]].reset_index().set_index(["GEO", "YEAR"])
-    relevant_groups = relevant.groupby("AGEGRP")
-    mygroup = lambda i: relevant_groups.get_group(i).drop("AGEGRP", axis=1)
-    daughters, bottom, top = (mygroup(i) for i in (1,4,10))
-    mothers = sum(mygroup(i) for i in range(5,10)) + (bottom+top)/2
-    
-    crr = (daughters*6 / mothers).round(2).rename(columns=lambda x: x[0]+'_CRR')
-    crr = replace_inf(crr)
-    ace = (replace_inf(daughters-top)/5).round(0).astype(int).rename(columns=lambda x: x[0]+'_ACE')
+    relevant = Geocdf[[race+"_FEMALE" for race in my_races]]
+    pop, keys = cohort_array(relevant.droplevel("AGEGRP"), relevant.index.get_level_values("AGEGRP"))
     
     global alldata
-    alldata = pd.concat([crr, ace], axis=1)
+    alldata = crr_ace_frame(pop, keys, my_races)
+    stage_rows(len(relevant))
     # crr = crude reproduction rate, an approximation of the net reproduction rate
     # ace = annual cohort exchange
 
@@ -203,28 +275,49 @@ def write_data():
     # for consistency's sake I'm using July 2010 estimate for 2010 population instead
     # of April 2010 estimate, because every other year uses the July estimate
     os.makedirs('DATA', exist_ok=True)
-    for idx, data in alldata.groupby(level=1):
-        if not (3 <= idx < 13): continue
-        data = data.reset_index().set_index("GEO").drop("YEAR", axis=1)
-        data.to_csv(f'DATA{os.sep}{yearcodes(idx)}.tsv', sep='\t')
+    stage_rows(len(alldata))
+    outputs = write_tsvs(alldata, "YEAR", lambda idx: f'DATA{os.sep}{yearcodes(idx)}.tsv' if 3 <= idx < 13 else None)
+    if output_settings['parquet']:
+        outputs += write_parquet(alldata, "YEAR", lambda idx: {'country': 'usa', 'year': yearcodes(idx)} if 3 <= idx < 13 else None)
+    return outputs
 
-def main2(param):
+def main2(param, force=False):
     global decade
     decade = param
     assert decade in {2000, 2010}
     
-    download_datasets()
-    load_PSAdf()
-    load_ccest()
-    porcess_geos()
-    append_geos()
-    add_myrace_columns()
-    porcess_data()
-    write_data()
-
-def main():
-    main2(2000)
-    main2(2010)
+    download_datasets([decade])
+    # a decade's tsvs only depend on its cc-est vintage, the PSA delineations and this code
+    manifest = Manifest()
+    job = f'usa {decade}'
+    dependencies = manifest.dependencies([ccest_paths[decade]], psa=manifest.digest(PSApath),
+                                         code=code_version(__file__), parquet=output_settings['parquet'])
+    if not force and manifest.fresh(job, dependencies):
+        print(f"{job} is up to date")
+        return
+    with stage_context(country='usa', year=decade):
+        load_PSAdf()
+        load_ccest()
+        porcess_geos()
+        append_geos()
+        add_myrace_columns()
+        porcess_data()
+        outputs = write_data()
+    manifest.record(job, dependencies, outputs)
+    return outputs
+
+def main(force=False):
+    download_datasets([2000, 2010])
+    main2(2000, force)
+    main2(2010, force)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='rebuild every decade, even if its inputs are unchanged')
+    parser.add_argument('--parquet', help='also write to this parquet dataset, partitioned by country and year')
+    parser.add_argument('--memmap', help='keep the value blocks as memory-mapped files in this folder')
+    args = parser.parse_args()
+    if args.parquet: parquet_to(args.parquet)
+    if args.memmap: memmap_to(args.memmap)
+    main(force=args.force)
+    if profile_settings['path']: profile_summary()
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+@author: EAweblog
+
+Benchmarks the three pipelines end to end on synthetic fixtures (see
+fixtures.py), so that the stages can be timed offline and at different scales:
+
+    python benchmarks/bench.py                         # all countries, small
+    python benchmarks/bench.py usa nz --scale large --repeat 3 --cold
+    python benchmarks/bench.py canada --workdir /tmp/fp-bench --out bench.json
+    python benchmarks/bench.py usa --scale large --memmap
+    python benchmarks/bench.py usa canada --scale medium --states 20 --cmas 60 --years 3
+
+--states, --counties, --cmas, --areas and --years override the scale's
+preset. --years is the number of estimate years in each cc-est file, and the
+number of census years (the first ones) for Canada and NZ.
+
+Every stage is profiled by clickwatch as usual; the stage table of every run
+is printed, then the totals per country and repeat. Repeats after the first
+hit the .npz and .codes.json caches unless --cold is given. The rebuild
+manifest is ignored, every run recomputes every year. The process' RSS peak
+only ever grows across countries and repeats, so with --tracemalloc (or
+FP_TRACEMALLOC=1) the peak reported is the largest tracemalloc peak of the
+run's own stages instead.
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import argparse
+from time import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(here)
+sys.path[:0] = [here, repo]
+import helpers
+import fixtures
+
+scales = {'small':  {'usa': dict(states=3, counties_per_state=8),
+                     'canada': dict(cmas=4),
+                     'nz': dict(areas=4)},
+          'medium': {'usa': dict(states=10, counties_per_state=30),
+                     'canada': dict(cmas=30),
+                     'nz': dict(areas=9)},
+          # about the size of the real inputs
+          'large':  {'usa': dict(states=50, counties_per_state=63),
+                     'canada': dict(cmas=150),
+                     'nz': dict(areas=18)}}
+
+canada_years = (2001, 2006, 2011, 2016)
+nz_years = (2006, 2013, 2018)
+
+##############################################################################################################################################################
+def setup_usa(module, states, counties_per_state, years=None):
+    fixtures.write_ccest(os.path.join(module.dir2000, module.fn2000), states, counties_per_state, years=years or 13, pad=False)
+    fixtures.write_ccest(os.path.join(module.dir2010, module.fn2010), states, counties_per_state, years=years or 12, seed=1)
+    open(module.PSApath, 'w').close() # the delineations come from psa_frame, this only keeps get_files quiet
+
+def run_usa(module, states, counties_per_state, years=None):
+    @helpers.clickwatch
+    def load_PSAdf():
+        """loading PSA dataframe"""
+        module.PSAdf = fixtures.psa_frame(states, counties_per_state)
+        helpers.stage_rows(len(module.PSAdf))
+    module.load_PSAdf = load_PSAdf
+    module.main(force=True)
+
+def setup_canada(module, cmas, years=None):
+    fixtures.write_canada('.', module.VM_table, module.AI_table, canada_years[:years], cmas=cmas)
+
+def run_canada(module, cmas, years=None, workers=None):
+    module.main(canada_years[:years], workers=workers, force=True)
+
+def setup_nz(module, areas, years=None):
+    fixtures.write_dtr4(module.dtr4path, module.all_ethnic_groups, areas, nz_years[:years])
+
+def run_nz(module, areas, years=None):
+    module.main(force=True)
+
+pipelines = {'usa':    ('assets-usa/cc-est-eval.py', setup_usa, run_usa),
+             'canada': ('assets-canada/VMAI-eval.py', setup_canada, run_canada),
+             'nz':     ('assets-nz/dtr4-eval.py', setup_nz, run_nz)}
+caches = ['**/*.npz', '*.codes.json']
+##############################################################################################################################################################
+
+def bench(country, workdir, params, repeat=1, cold=False, **kwargs):
+    path, setup, run = pipelines[country]
+    module = helpers.load_script(os.path.join(repo, path), country)
+    dirname = os.path.join(workdir, country)
+    os.makedirs(dirname, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        # fixtures are reused as long as they were made at the same scale
+        stamp = json.dumps(params, sort_keys=True)
+        if not os.path.exists('fixtures.json') or open('fixtures.json').read() != stamp:
+            print(f'writing {country} fixtures {stamp}')
+            for cache in caches:
+                for fn in glob.glob(cache, recursive=True): os.remove(fn)
+            setup(module, **params)
+            with open('fixtures.json', 'w') as file: file.write(stamp)
+        results = []
+        for i in range(repeat):
+            if cold:
+                for cache in caches:
+                    for fn in glob.glob(cache, recursive=True): os.remove(fn)
+            # a run id per repeat keeps every summary to its own stages
+            helpers.run_id = os.environ['FP_RUN'] = f'bench-{os.getpid()}-{country}-{i}'
+            t0 = time()
+            run(module, **params, **kwargs)
+            wall = time() - t0
+            helpers.profile_summary()
+            with open(helpers.profile_settings['path']) as file:
+                records = [r for r in map(json.loads, file) if r['run'] == helpers.run_id]
+            peak = 'peak_mb' if helpers.profile_settings['tracemalloc'] else 'peak_rss_mb'
+            results.append({'country': country, 'repeat': i, 'wall': wall,
+                            'stages': sum(r['wall'] for r in records),
+                            peak: max((r.get(peak) or 0 for r in records), default=None),
+                            **params})
+        return results
+    finally:
+        os.chdir(cwd)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the pipelines on synthetic fixtures')
+    parser.add_argument('countries', nargs='*', help=f"any of {', '.join(pipelines)} (all of them by default)")
+    parser.add_argument('--scale', default='small', choices=list(scales))
+    parser.add_argument('--states', type=int, help='USA states')
+    parser.add_argument('--counties', type=int, help='USA counties per state')
+    parser.add_argument('--cmas', type=int, help='Canada CMA/CAs')
+    parser.add_argument('--areas', type=int, help='NZ regional council areas')
+    parser.add_argument('--years', type=int, help='years per USA decade, census years for Canada and NZ')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--cold', action='store_true', help='remove the parse caches before every repeat')
+    parser.add_argument('--workers', type=int, default=None, help='table-parsing processes for canada')
+    parser.add_argument('--tracemalloc', action='store_true', help="report every stage's own tracemalloc peak")
+    parser.add_argument('--memmap', action='store_true', help='keep the USA value blocks in memory-mapped files in the workdir')
+    parser.add_argument('--workdir', help='keep fixtures and outputs here instead of a temporary directory')
+    parser.add_argument('--out', help='also write the results to this json file')
+    args = parser.parse_args()
+    for country in args.countries:
+        if country not in pipelines: parser.error(f'unknown country {country}')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fp-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    tracing = args.tracemalloc or helpers.profile_settings['tracemalloc']
+    helpers.profile_to(os.path.join(workdir, 'profile.jsonl'), tracing)
+    os.environ['FP_PROFILE'] = helpers.profile_settings['path']
+    if tracing: os.environ['FP_TRACEMALLOC'] = '1' # for the canada workers
+    if args.memmap: helpers.memmap_to(os.path.join(workdir, 'memmap'))
+    try:
+        results = []
+        for country in args.countries or pipelines:
+            kwargs = {'workers': args.workers} if country == 'canada' else {}
+            overrides = {'usa': {'states': args.states, 'counties_per_state': args.counties},
+                         'canada': {'cmas': args.cmas},
+                         'nz': {'areas': args.areas}}[country] | {'years': args.years}
+            params = scales[args.scale][country] | {k: v for k, v in overrides.items() if v is not None}
+            results += bench(country, workdir, params, args.repeat, args.cold, **kwargs)
+    finally:
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    import pandas as pd
+    print()
+    print(pd.DataFrame(results).set_index(['country', 'repeat']).round(2).to_string())
+    if args.out:
+        with open(args.out, 'w') as file: json.dump(results, file, indent=1)
+
+if __name__ == '__main__':
+    main()
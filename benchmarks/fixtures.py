@@ -0,0 +1,161 @@
+"""
+@author: EAweblog
+
+Synthetic but schema-faithful inputs for the three pipelines, so that they can
+be benchmarked offline: cc-est alldata csv files and PSA delineations (USA),
+SDMX Generic/Structure ZIPs like the StatCan tables (Canada), and a DTR4 tab
+separated export (New Zealand). Values are random, shapes and labels are not.
+"""
+
+import io
+import os
+from itertools import product
+from zipfile import ZipFile, ZIP_DEFLATED
+import numpy as np
+import pandas as pd
+
+##############################################################################################################################################################
+# USA
+
+census_races = ['W', 'B', 'I', 'A', 'N']
+sexes = ['MALE', 'FEMALE']
+
+def ccest_columns():
+    cols = ['TOT_POP', 'TOT_MALE', 'TOT_FEMALE']
+    for his in ['', 'NH', 'H']:
+        if his: cols += [his + '_' + sex for sex in sexes]
+        cols += [his + crace + 'A_' + sex for crace, sex in product(census_races, sexes)]
+        cols += [his + 'TOM_' + sex for sex in sexes]
+        cols += [his + crace + 'AC_' + sex for crace, sex in product(census_races, sexes)]
+    return cols
+
+def counties(states, counties_per_state):
+    return [(ste, cty) for ste in range(1, states+1) for cty in range(1, 2*counties_per_state, 2)]
+
+def write_ccest(path, states=5, counties_per_state=12, years=12, pad=True, seed=0):
+    '''
+    cc-est alldata csv with every county x YEAR (1..years) x AGEGRP (0..18);
+    pad=False writes unpadded FIPS codes like the 2000s file
+    '''
+    rng = np.random.default_rng(seed)
+    geo = counties(states, counties_per_state)
+    keys = np.array([(ste, cty, y, a) for (ste, cty), y, a in product(geo, range(1, years+1), range(19))])
+    df = pd.DataFrame({'SUMLEV': 50,
+                       'STATE': keys[:,0], 'COUNTY': keys[:,1],
+                       'STNAME': [f'State {ste}' for ste in keys[:,0]],
+                       'CTYNAME': [f'County {cty}' for cty in keys[:,1]],
+                       'YEAR': keys[:,2], 'AGEGRP': keys[:,3]})
+    if pad:
+        df['STATE'] = df['STATE'].map('{:02d}'.format)
+        df['COUNTY'] = df['COUNTY'].map('{:03d}'.format)
+    values = {}
+    for col in ccest_columns():
+        if 'AC_' in col: values[col] = values[col.replace('AC_', 'A_')] + rng.integers(0, 300, len(df))
+        else: values[col] = rng.integers(0, 5000, len(df))
+    df = pd.concat([df, pd.DataFrame(values)], axis=1)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df.to_csv(path, index=False)
+
+def psa_frame(states=5, counties_per_state=12):
+    '''PSAdf as load_PSAdf builds it: two of every three counties are in a CBSA, half of those in a CSA'''
+    rows = []
+    for i, (ste, cty) in enumerate(counties(states, counties_per_state)):
+        if i % 3 == 2: continue
+        rows.append({'CBSA Code': f'{10000 + 10*ste + i%2:05d}',
+                     'CSA Code': str(100 + ste) if i % 2 == 0 else np.nan,
+                     'FIPS State Code': f'{ste:02d}',
+                     'FIPS County Code': f'{cty:03d}'})
+    PSAdf = pd.DataFrame(rows)
+    PSAdf.set_index(PSAdf['FIPS State Code'] + PSAdf['FIPS County Code'], inplace=True)
+    return PSAdf
+
+##############################################################################################################################################################
+# Canada
+
+message = 'http://www.SDMX.org/resources/SDMXML/schemas/v2_0/message'
+generic = 'http://www.SDMX.org/resources/SDMXML/schemas/v2_0/generic'
+structure = 'http://www.SDMX.org/resources/SDMXML/schemas/v2_0/structure'
+
+CL_AGE = {'1': 'Total - Age', '2': '0 to 14 years', '3': 'Under 5 years'}
+CL_AGE.update({str(4+i): f'{5*(i+1)} to {5*(i+1)+4} years' for i in range(17)})
+CL_AGE.update({'21': '90 years and over', '22': '15 to 24 years'})
+CL_SEX = {'1': 'Total - Sex', '2': 'Male', '3': 'Female'}
+
+def canada_geos(cmas=6):
+    '''Canada, the provinces, cmas CMA/CAs and the provincial parts of the first one'''
+    provinces = ['10', '11', '12', '13', '24', '35', '46', '47', '48', '59']
+    geos = ['01'] + provinces
+    for i in range(cmas):
+        geos.append(f'{provinces[i % len(provinces)]}{500+i:03d}')
+    geos += [geos[11] + geos[11][:2], geos[11] + provinces[1]]
+    return geos
+
+def structure_xml(codelists):
+    out = [f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<message:Structure xmlns:message="{message}" xmlns:structure="{structure}"><message:CodeLists>']
+    for cl, codes in codelists.items():
+        out.append(f'<structure:CodeList id="{cl}" agencyID="STC"><structure:Name xml:lang="en">{cl}</structure:Name>')
+        for k, v in codes.items():
+            out.append(f'<structure:Code value="{k}"><structure:Description xml:lang="en">{v}</structure:Description>'
+                       f'<structure:Description xml:lang="fr">{v}</structure:Description></structure:Code>')
+        out.append('</structure:CodeList>')
+    out.append('</message:CodeLists></message:Structure>')
+    return ''.join(out)
+
+def generic_xml(dims, year, rng):
+    # StatCan's Generic files start with a BOM
+    yield (f'﻿<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<message:GenericData xmlns:message="{message}" xmlns:generic="{generic}">'
+           f'<message:Header><message:ID>fixture</message:ID></message:Header><message:DataSet>')
+    for combo in product(*dims.values()):
+        key = ''.join(f'<generic:Value concept="{c}" value="{v}"/>' for c, v in zip(dims, combo))
+        yield (f'<generic:Series><generic:SeriesKey>{key}</generic:SeriesKey>'
+               f'<generic:Obs><generic:Time>{year}</generic:Time>'
+               f'<generic:ObsValue value="{rng.integers(0, 3000)}"/></generic:Obs></generic:Series>\n')
+    yield '</message:DataSet></message:GenericData>'
+
+def write_sdmx(path, table, dims, year, seed=0):
+    rng = np.random.default_rng(seed)
+    codelists = {'CL_GEO': {g: f'Geo {g}' for g in dims['GEO']}, 'CL_AGE': CL_AGE, 'CL_SEX': CL_SEX}
+    with ZipFile(path, 'w', ZIP_DEFLATED) as myzip:
+        myzip.writestr(f'Structure_{table}.xml', structure_xml(codelists))
+        with myzip.open(f'Generic_{table}.xml', 'w') as f:
+            for chunk in generic_xml(dims, year, rng): f.write(chunk.encode('utf-8'))
+
+def write_canada(dirname, VM_table, AI_table, years=(2001, 2006, 2011, 2016), cmas=6, seed=0):
+    '''VM and AI ZIPs for every year, with the dimensions VMAI-eval.py filters on'''
+    geos = canada_geos(cmas)
+    for year in years:
+        VM_condition = {2016: 'DIM2', 2011: 'GENSTPOB', 2006: 'YRIM'}.get(year)
+        AI_condition = {2016: 'RGINDR', 2011: 'RGINDR'}.get(year)
+        AI_key = 'B01_ABORIG_IDENTITY' if year == 2001 else 'ABIDENT'
+        VM_dims = {'GEO': geos, 'AGE': list(CL_AGE), 'SEX': list(CL_SEX), 'DVISMIN': [str(i) for i in range(1, 16)]}
+        AI_dims = {'GEO': geos, AI_key: ['1', '2', '3'], 'AGE': list(CL_AGE), 'SEX': list(CL_SEX)}
+        if VM_condition: VM_dims[VM_condition] = ['1', '2']
+        if AI_condition: AI_dims[AI_condition] = ['1', '2']
+        os.makedirs(dirname, exist_ok=True)
+        write_sdmx(os.path.join(dirname, f'{VM_table[year]}.ZIP'), VM_table[year], VM_dims, year, seed)
+        write_sdmx(os.path.join(dirname, f'{AI_table[year]}.ZIP'), AI_table[year], AI_dims, year, seed+1)
+
+##############################################################################################################################################################
+# New Zealand
+
+nz_ages = (['Total people - age group'] + [f'{5*i}-{5*i+4} years' for i in range(18)]
+           + ['90 years and over'])
+nz_sexes = ['Total people - sex', 'Male', 'Female']
+
+def write_dtr4(path, ethnic_groups, areas=18, years=(2006, 2013, 2018), seed=0):
+    '''
+    DTR4 export as nzdotstat delivers it: a ZIP (named .gz) with a data and a
+    footnotes csv, quoted labels, tab separated, values with flags
+    '''
+    rng = np.random.default_rng(seed)
+    area_names = [f'Region {i}' for i in range(areas-1)] + ['Total - Regional Council Areas']
+    with ZipFile(path, 'w', ZIP_DEFLATED) as myzip:
+        myzip.writestr('TABLECODE8338_FootnotesLegend_fixture.csv', 'Footnotes\r\n')
+        with io.TextIOWrapper(myzip.open('TABLECODE8338_Data_fixture.csv', 'w'), newline='') as f:
+            f.write('Area\tYear\tSex\tAge group\tEthnic group\tValue  Flags\r\n')
+            for area, eth, age, sex, year in product(area_names, ethnic_groups, nz_ages, nz_sexes, years):
+                value = rng.integers(0, 5000)
+                value = f'{value}  ' if value % 11 else '  c' # some confidentialised cells
+                f.write(f'"{area}"\t"{year}"\t"{sex}"\t"{age}"\t"{eth}"\t{value}\r\n')
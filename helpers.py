@@ -5,48 +5,779 @@ Various helper functions for common Fertility Project tasks
 """
 
 import os
-from urllib.request import urlretrieve
-from time import time, sleep
+import re
+import json
+import hashlib
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+import base64
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep, monotonic, process_time
+from contextlib import contextmanager
+import sys
+import tracemalloc
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # only needed for parquet output
+    pa = pq = None
+from functools import wraps, partial
+from collections import OrderedDict, namedtuple, defaultdict
+from threading import Lock, Semaphore, Event, Thread, local
+from queue import Queue, Full
+import pickle
+import struct
+import zipfile
+import importlib.util
 import numpy as np
+import pandas as pd
 
 def replace_inf(df):
     return df.replace([-np.inf, np.nan, np.inf], 0)
 
+def append_frame(df, other, name=None):
+    '''
+    returns df with the rows of other (same columns and index levels) appended,
+    written into a single preallocated block (value_block(name, ...) if a name
+    is given). The MultiIndex is built from the level codes of both frames
+    instead of from tuples.
+    '''
+    n = len(df)
+    dtype = np.result_type(*df.dtypes, *other.dtypes)
+    shape = (n + len(other), df.shape[1])
+    block = value_block(name, shape, dtype) if name else np.empty(shape, dtype=dtype)
+    # filled a chunk of rows at a time, so that every page of the block (which
+    # may be a memory-mapped file) is written in one go
+    other = other[df.columns]
+    chunk = 1 << 16
+    for start, frame in [(0, df), (n, other)]:
+        for i in range(0, len(frame), chunk):
+            rows = frame.iloc[i:i+chunk].to_numpy(dtype)
+            block[start+i:start+i+len(rows)] = rows
+    levels, codes = [], []
+    for a, b, a_codes, b_codes in zip(df.index.levels, other.index.levels,
+                                      df.index.codes, other.index.codes):
+        level = a.append(b).unique()
+        levels.append(level)
+        codes.append(np.concatenate([level.get_indexer(a)[a_codes],
+                                     level.get_indexer(b)[b_codes]]))
+    index = pd.MultiIndex(levels=levels, codes=codes, names=df.index.names,
+                          verify_integrity=False)
+    return pd.DataFrame(block, index=index, columns=df.columns, copy=False)
+
+def cohort_array(df, cohorts):
+    '''
+    scatters the rows of df into a (key x cohort x column) array, where key is
+    the index of df and cohorts holds the integer cohort of every row; returns
+    the array and the distinct keys in order of appearance. Cells no row fills
+    are NaN, so a key missing a cohort gets a CRR and ACE of 0 from crr_ace.
+    '''
+    cohorts = np.asarray(cohorts)
+    key_codes, keys = pd.factorize(df.index)
+    pop = np.full((len(keys), max(19, cohorts.max()+1), df.shape[1]), np.nan)
+    pop[key_codes, cohorts] = df.to_numpy()
+    return pop, keys.set_names(df.index.names)
+
+def crr_ace(pop):
+    '''
+    CRR and ACE arrays from an array of female populations shaped
+    (..., cohort, race), in one vectorized pass over the cohort axis
+    '''
+    # The heuristic to remember the USA (standard) cohorts is C[0] is total population,
+    # C[18] is 85+ population, and C[i] for 0 < i < 18 is P(5(i-1),5i)
+    daughters, bottom, top = (pop[..., i, :] for i in (1,4,10))
+    mothers = sum(pop[..., i, :] for i in range(5,10)) + (bottom+top)/2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crr = np.round(daughters*6 / mothers, 2)
+    crr[~np.isfinite(crr)] = 0
+    ace = np.round(np.nan_to_num(daughters-top, posinf=0, neginf=0) / 5).astype(int)
+    # crr = crude reproduction rate, an approximation of the net reproduction rate
+    # ace = annual cohort exchange
+    return crr, ace
+
+def crr_ace_frame(pop, keys, races):
+    '''dataframe of CRR and ACE columns for every race, indexed by keys'''
+    crr, ace = crr_ace(pop)
+    return pd.concat([pd.DataFrame(crr, index=keys, columns=[r+'_CRR' for r in races]),
+                      pd.DataFrame(ace, index=keys, columns=[r+'_ACE' for r in races])], axis=1)
+
+class Interned(dict):
+    '''numbers every new key in order of appearance'''
+    def __missing__(self, key):
+        self[key] = len(self)
+        return self[key]
+
+def file_stamp(path):
+    '''cheap cache key for a source file: its size and modification time'''
+    st = os.stat(path)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+def file_digest(path):
+    '''sha256 hex digest of the content of a file'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): digest.update(chunk)
+    return digest.hexdigest()
+
+def cached_json(cachepath, source, build):
+    '''
+    the json-able result of build(), cached in cachepath and keyed by the name
+    and content hash of the source file it was built from. The hash is only
+    recomputed when the size or modification time of source changes.
+    '''
+    key = {'source': os.path.basename(source), 'stamp': file_stamp(source)}
+    cached = None
+    if os.path.exists(cachepath):
+        with open(cachepath, encoding='utf-8') as f: cached = json.load(f)
+        if cached['source'] != key['source']: cached = None
+        elif cached['stamp'] == key['stamp']: return cached['value']
+    key['digest'] = file_digest(source)
+    if cached is not None and cached['digest'] == key['digest']:
+        value = cached['value'] # same content, only the stamp is refreshed
+    else:
+        value = build()
+    with open(cachepath + '.tmp', 'w', encoding='utf-8') as f: json.dump(key | {'value': value}, f)
+    os.replace(cachepath + '.tmp', cachepath)
+    return value
+
+def save_frame(path, df, key):
+    '''
+    stores a homogeneous DataFrame with a MultiIndex as an uncompressed .npz
+    (value block, column names, index levels and codes) tagged with key
+    '''
+    arrays = {'key': np.array(key),
+              'values': df.to_numpy(),
+              'columns': np.array(df.columns.tolist()),
+              'names': np.array(df.index.names)}
+    for i, (level, codes) in enumerate(zip(df.index.levels, df.index.codes)):
+        arrays[f'level{i}'] = np.array(level.tolist())
+        arrays[f'codes{i}'] = codes
+    with open(path + '.tmp', 'wb') as f: np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+def load_frame(path, key, mmap=False):
+    '''
+    the DataFrame stored by save_frame, or None if path is missing or stale;
+    with mmap its values are a read-only memory map of the file (see npz_memmap)
+    '''
+    if not os.path.exists(path): return None
+    with np.load(path) as npz:
+        if str(npz['key']) != key: return None
+        names = npz['names'].tolist()
+        index = pd.MultiIndex(levels=[npz[f'level{i}'] for i in range(len(names))],
+                              codes=[npz[f'codes{i}'] for i in range(len(names))],
+                              names=names, verify_integrity=False)
+        values = npz_memmap(path, npz, 'values') if mmap else npz['values']
+        return pd.DataFrame(values, index=index, columns=npz['columns'].tolist(), copy=False)
+
+def npz_memmap(path, npz, name):
+    '''
+    a read-only memory map of an array of an open .npz, which np.load can't
+    map; np.savez doesn't compress, so the array's bytes lie in one piece
+    after the zip entry's local header and the .npy header
+    '''
+    info = npz.zip.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED: return npz[name]
+    with npz.zip.open(info) as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        header = f.tell()
+    with open(path, 'rb') as f:
+        f.seek(info.header_offset)
+        local = f.read(30)
+    filename, extra = struct.unpack('<HH', local[26:30])
+    offset = info.header_offset + 30 + filename + extra + header
+    return np.memmap(path, dtype, 'r', offset, shape, 'F' if fortran_order else 'C')
+
+# With FP_MEMMAP set to a folder (or given to memmap_to) the pipelines keep
+# their big value blocks as memory-mapped .npy files there, and map their
+# .npz caches instead of reading them, so that the OS can drop the pages
+# that aren't being worked on. The results are the same either way.
+storage_settings = {'memmap': os.environ.get('FP_MEMMAP')}
+
+def memmap_to(dirname):
+    storage_settings.update(memmap=dirname)
+
+def value_block(name, shape, dtype):
+    '''
+    a zero-filled array, in memory or, with FP_MEMMAP, mapped from the file
+    name.npy in that folder. The file is unlinked at once and goes away with
+    the last view of it (on Windows it stays, to be overwritten next time).
+    '''
+    if not storage_settings['memmap']: return np.zeros(shape, dtype)
+    ensure_dir(storage_settings['memmap'])
+    path = os.path.join(storage_settings['memmap'], f'{name}.npy')
+    block = np.lib.format.open_memmap(path, 'w+', dtype, shape)
+    try: os.remove(path)
+    except OSError: pass
+    return block
+
+def tsv_quote(field):
+    '''quotes a field the way the csv module does with QUOTE_MINIMAL'''
+    if any(c in field for c in '\t"\r\n'): return '"' + field.replace('"', '""') + '"'
+    return field
+
+def tsv_strings(values):
+    '''
+    the strings to_csv writes for a column, formatting every distinct value
+    only once: floats as the shortest repr of their own precision (NaN as
+    empty), anything else with str
+    '''
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        # keyed by bit pattern, so that -0.0 and 0.0 stay distinct
+        values = np.ascontiguousarray(values)
+        uniques, inverse = np.unique(values.view(f'u{values.itemsize}'), return_inverse=True)
+        uniques = uniques.view(values.dtype)
+        if values.dtype == np.float64: strings = ['' if x != x else repr(x) for x in uniques.tolist()]
+        else: strings = ['' if x != x else str(x) for x in uniques] # e.g. 0.1, not 0.10000000149011612 for float32
+    else:
+        uniques, inverse = np.unique(values, return_inverse=True)
+        strings = [tsv_quote(str(x)) for x in uniques.tolist()]
+    return np.array(strings, dtype=object)[inverse.ravel()]
+
+def partition_rows(index, level):
+    '''
+    {key: positions of its rows} for every key of an index level, from the
+    level codes; rows keep their order within each key, like groupby and xs
+    '''
+    index = index.remove_unused_levels()
+    pos = index.names.index(level)
+    codes = index.codes[pos]
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(index.levels[pos])))
+    return {index.levels[pos][k]: order[bounds[k]-n:bounds[k]]
+            for k, n in enumerate(np.diff(bounds, prepend=0))}
+
+def write_tsvs(df, level, path_of, workers=4):
+    '''
+    writes the same bytes as df.xs(key, level=level).to_csv(path_of(key), sep='\t')
+    for every key of an index level, skipping keys path_of maps to None. The
+    rows are partitioned by the level codes once, every column is formatted
+    once, and the files are written concurrently, each to a temporary file
+    that is then renamed. Returns the paths written.
+    '''
+    rest = df.index.droplevel(level)
+    fields = [tsv_strings(rest.get_level_values(i)) for i in range(rest.nlevels)]
+    fields += [tsv_strings(df[c].to_numpy()) for c in df.columns]
+    header = '\t'.join(tsv_quote('' if name is None else str(name)) for name in [*rest.names, *df.columns])
+    lines = np.array(['\t'.join(row) for row in zip(*fields)], dtype=object)
+    parts = {key: lines[rows] for key, rows in partition_rows(df.index, level).items()}
+    paths = {key: path_of(key) for key in parts}
+    
+    def write(key):
+        with open(paths[key] + '.tmp', 'w', encoding='utf-8', newline='') as file:
+            file.write(os.linesep.join([header, *parts[key], '']))
+        os.replace(paths[key] + '.tmp', paths[key])
+    keys = [key for key in parts if paths[key] is not None]
+    with ThreadPoolExecutor(workers) as pool: list(pool.map(write, keys))
+    return [paths[key] for key in keys]
+
+# With FP_PARQUET set (or a path given to parquet_to) the pipelines also write
+# their CRR and ACE frames to one parquet dataset partitioned by country and
+# year, e.g. DATA.parquet/country=usa/year=2005/part-0.parquet, with GEO as a
+# dictionary column, CRR as float32 and ACE as int32. Every file has the same
+# schema, with the CRR and ACE of every race (null for races a country doesn't
+# have), which is also written to _common_metadata at the root of the dataset,
+# so readers don't lose columns to the first file they look at. pyarrow is
+# only needed then.
+output_settings = {'parquet': os.environ.get('FP_PARQUET')}
+parquet_races = ['E', 'W', 'B', 'R', 'Y', 'N', 'Z']
+
+def parquet_to(path):
+    output_settings.update(parquet=path)
+
+def parquet_schema():
+    return pa.schema([("GEO", pa.dictionary(pa.int32(), pa.string())),
+                      *((r + '_CRR', pa.float32()) for r in parquet_races),
+                      *((r + '_ACE', pa.int32()) for r in parquet_races)])
+
+def write_parquet(df, level, partition_of):
+    '''
+    writes the rows of df for every key of an index level (all of them if
+    level is None) to the partition partition_of(key), e.g. {'country': 'usa',
+    'year': 2005}, skipping keys it maps to None. Returns the paths written.
+    '''
+    if pa is None: raise ImportError("writing parquet needs pyarrow")
+    schema = parquet_schema()
+    unknown = set(df.columns) - set(schema.names)
+    if unknown: raise ValueError(f"no parquet column for {', '.join(sorted(unknown))}")
+    ensure_dir(output_settings['parquet'])
+    common = os.path.join(output_settings['parquet'], '_common_metadata')
+    pq.write_metadata(schema, common + '.tmp')
+    os.replace(common + '.tmp', common)
+    parts = partition_rows(df.index, level) if level else {None: np.arange(len(df))}
+    paths = []
+    for key, rows in parts.items():
+        partition = partition_of(key)
+        if partition is None: continue
+        part = df.iloc[rows]
+        geos = part.index.get_level_values("GEO").astype(str)
+        columns = [pa.array(geos).dictionary_encode().cast(schema.field("GEO").type)]
+        for field in list(schema)[1:]:
+            if field.name in part: columns.append(pa.array(part[field.name].to_numpy(field.type.to_pandas_dtype()), field.type))
+            else: columns.append(pa.nulls(len(part), field.type))
+        table = pa.Table.from_arrays(columns, schema=schema)
+        dirname = os.path.join(output_settings['parquet'], *(f'{k}={v}' for k, v in partition.items()))
+        ensure_dir(dirname)
+        paths.append(os.path.join(dirname, 'part-0.parquet'))
+        pq.write_table(table, paths[-1] + '.tmp')
+        os.replace(paths[-1] + '.tmp', paths[-1])
+    return paths
+
 def ensure_dir(dirname):
     if not os.path.exists(dirname): os.makedirs(dirname)
 
+def code_version(*paths):
+    '''sha256 of the given source files and of this one, for rebuild manifests'''
+    digest = hashlib.sha256()
+    for path in (*paths, __file__):
+        with open(path, 'rb') as f: digest.update(f.read())
+    return digest.hexdigest()
+
+class Manifest:
+    '''
+    DATA/manifest.json records, for every job (e.g. 'usa 2010'), the digests
+    of the inputs and the code version its outputs were built from, so that
+    a job whose dependencies haven't changed and whose outputs still exist can
+    be skipped. Input digests are only recomputed when a file's stamp changes.
+    '''
+    def __init__(self, path=f'DATA{os.sep}manifest.json'):
+        self.path = path
+        self.data = {'digests': {}, 'jobs': {}}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f: self.data = json.load(f)
+
+    def digest(self, path):
+        stamp = file_stamp(path)
+        known = self.data['digests'].get(path)
+        if known is None or known[0] != stamp:
+            known = self.data['digests'][path] = [stamp, file_digest(path)]
+        return known[1]
+
+    def dependencies(self, inputs, **versions):
+        return {'inputs': {path: self.digest(path) for path in inputs}, **versions}
+
+    def fresh(self, job, dependencies):
+        entry = self.data['jobs'].get(job)
+        return (entry is not None and entry['dependencies'] == dependencies
+                and all(os.path.exists(path) for path in entry['outputs']))
+
+    def record(self, job, dependencies, outputs):
+        ensure_dir(os.path.dirname(self.path) or '.')
+        # jobs of other processes may have been recorded since this was read
+        with file_lock(self.path + '.lock'):
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f: data = json.load(f)
+                data['digests'].update(self.data['digests'])
+                self.data = data
+            self.data['jobs'][job] = {'dependencies': dependencies, 'outputs': list(outputs)}
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f: json.dump(self.data, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+@contextmanager
+def file_lock(path, timeout=600):
+    '''a lock shared between processes, held by whoever manages to create path'''
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if monotonic() > deadline: raise TimeoutError(f'{path} is still locked, remove it if no job is running')
+            sleep(0.05)
+    try: yield
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+def load_script(path, name):
+    '''imports one of the hyphenated pipeline scripts as a module named name'''
+    path = os.path.abspath(path)
+    if os.path.dirname(path) not in sys.path: sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module # so that process pools can pickle its stages by name
+    spec.loader.exec_module(module)
+    return module
+
+# Every clickwatch'd pipeline stage leaves a record in stage_records with its
+# wall and CPU time, peak memory, rows and the country/year it ran for. The
+# records are appended as JSON lines to the file named by the FP_PROFILE
+# environment variable (or given to profile_to). With FP_TRACEMALLOC=1 the
+# peak is the stage's own tracemalloc peak, otherwise it's the process' RSS peak.
+# Records of one run (including its worker processes) share the same run id.
+# The scripts and run.py print the profile_summary table at the end only when
+# FP_PROFILE is set, since the Canada workers' records only reach it that way.
+run_id = os.environ.setdefault('FP_RUN', f'{time():.0f}-{os.getpid()}')
+stage_records = []
+stage_stack = []
+profile_settings = {'path': os.environ.get('FP_PROFILE'),
+                    'tracemalloc': os.environ.get('FP_TRACEMALLOC') == '1'}
+
+def profile_to(path, tracemalloc=False):
+    profile_settings.update(path=path, tracemalloc=tracemalloc)
+
+@contextmanager
+def stage_context(**context):
+    '''tags the stages run inside it, e.g. stage_context(country='usa', year=2010)'''
+    previous = stage_context.current
+    stage_context.current = previous | context
+    try: yield
+    finally: stage_context.current = previous
+stage_context.current = {}
+
+def stage_rows(n):
+    '''records the number of rows processed by the running stage'''
+    if stage_stack: stage_stack[-1]['rows'] = int(n)
+
+def peak_rss_mb():
+    if resource is None: return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
 def clickwatch(f):
+    @wraps(f) # keeps f picklable by name, e.g. for process pools
     def F(*args, **kwargs):
-        print((f.__doc__ or ''), end='')
-        t0 = time()
-        returned = f(*args, **kwargs)
-        t1 = time()
-        print(' :\t{:.2f} seconds'.format(t1-t0))
+        print(f.__doc__ or '', end='', flush=True) # the label shows what's running, the time follows
+        record = {'run': run_id, 'stage': f.__name__, **stage_context.current, 'rows': None}
+        if args and all(isinstance(x, (int, str)) for x in args): record['args'] = list(args)
+        if profile_settings['tracemalloc']:
+            if not tracemalloc.is_tracing(): tracemalloc.start()
+            tracemalloc.reset_peak()
+        stage_stack.append(record)
+        t0, c0 = time(), process_time()
+        try:
+            returned = f(*args, **kwargs)
+        finally:
+            stage_stack.pop()
+        record['wall'], record['cpu'] = time()-t0, process_time()-c0
+        if profile_settings['tracemalloc']:
+            record['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        else:
+            record['peak_rss_mb'] = peak_rss_mb()
+        if record['rows'] is None and hasattr(returned, 'shape'): record['rows'] = len(returned)
+        stage_records.append(record)
+        print(' :\t{:.2f} seconds'.format(record['wall']))
+        if profile_settings['path']:
+            with open(profile_settings['path'], 'a') as file: file.write(json.dumps(record) + '\n')
         return returned
     return F
 
-@clickwatch
-def download_file(path, url):
-    print(f'downloading {path}', end='')
-    sleep(1) # so as not to cause a server time-out
-    urlretrieve(url, path)
+def profile_summary():
+    '''prints a table of this run's stage records, slowest first'''
+    records = stage_records
+    if profile_settings['path'] and os.path.exists(profile_settings['path']):
+        with open(profile_settings['path']) as file: records = [json.loads(line) for line in file]
+    records = pd.DataFrame([r for r in records if r['run'] == run_id])
+    if records.empty: return
+    peak = 'peak_mb' if 'peak_mb' in records else 'peak_rss_mb'
+    if 'year' in records: records['year'] = records['year'].astype('Int64')
+    keys = [k for k in ('country', 'year', 'stage') if k in records]
+    table = records.groupby(keys, dropna=False, sort=False).agg(
+        calls=('wall', 'size'), wall=('wall', 'sum'), cpu=('cpu', 'sum'),
+        peak_mb=(peak, 'max'), rows=('rows', 'max'))
+    print(table.sort_values('wall', ascending=False).round(2).to_string())
+
+class Host:
+    '''per-host politeness: a minimum interval between requests and a cap on
+    concurrent connections'''
+    def __init__(self, min_interval, connections):
+        self.min_interval = min_interval
+        self.slots = Semaphore(connections)
+        self.lock = Lock()
+        self.last = 0
+    
+    def wait(self):
+        with self.lock:
+            delay = self.last + self.min_interval - monotonic()
+            if delay > 0: sleep(delay) # so as not to cause a server time-out
+            self.last = monotonic()
+
+class Downloader:
+    '''
+    downloads files over keep-alive connections (one per host and thread),
+    resuming partial downloads with HTTP Range requests. Each file is written
+    to path.part, checked against the expected size and optional sha256 and
+    only then renamed to path, so an existing path is always complete.
+    Proxies are taken from the environment, as urlretrieve did (see proxy).
+    '''
+    chunk = 1 << 20
+    
+    def __init__(self, min_interval=1, connections=2, retries=3, timeout=60):
+        self.min_interval, self.connections = min_interval, connections
+        self.retries, self.timeout = retries, timeout
+        self.hosts = defaultdict(lambda: Host(self.min_interval, self.connections))
+        self.hosts_lock = Lock()
+        self.local = local()
+    
+    def host(self, netloc):
+        with self.hosts_lock: return self.hosts[netloc]
+    
+    def proxy(self, scheme, netloc):
+        '''
+        (proxy host, proxy headers) for a host from http_proxy, https_proxy and
+        no_proxy (or the system settings), like urlretrieve, or None
+        '''
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(netloc): return None
+        parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        headers = {}
+        if parts.username is not None:
+            credentials = f'{unquote(parts.username)}:{unquote(parts.password or "")}'
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        return parts.netloc.rpartition('@')[2], headers
+    
+    def connection(self, scheme, netloc, fresh=False):
+        '''
+        (connection, proxy headers) for a host; the headers are None unless
+        requests go through an http proxy, which takes absolute urls
+        '''
+        conns = self.local.__dict__.setdefault('conns', {})
+        if fresh and (scheme, netloc) in conns: conns.pop((scheme, netloc))[0].close()
+        if (scheme, netloc) not in conns:
+            proxy = self.proxy(scheme, netloc)
+            if proxy is None:
+                Connection = HTTPSConnection if scheme == 'https' else HTTPConnection
+                conns[scheme, netloc] = Connection(netloc, timeout=self.timeout), None
+            elif scheme == 'https': # tunnelled through the proxy with CONNECT
+                conn = HTTPSConnection(proxy[0], timeout=self.timeout)
+                conn.set_tunnel(netloc, headers=proxy[1])
+                conns[scheme, netloc] = conn, None
+            else:
+                conns[scheme, netloc] = HTTPConnection(proxy[0], timeout=self.timeout), proxy[1]
+        return conns[scheme, netloc]
+    
+    def request(self, url, offset, validator=None, fresh=False):
+        '''
+        response to GET url (following redirects), from byte offset on if the
+        file still matches validator (an ETag or Last-Modified date)
+        '''
+        for _ in range(10):
+            parts = urlsplit(url)
+            host = self.host(parts.netloc)
+            host.wait()
+            conn, proxy_headers = self.connection(parts.scheme, parts.netloc, fresh)
+            target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            headers = {'User-Agent': 'Fertility-Project-assets'}
+            if proxy_headers is not None:
+                target = f'{parts.scheme}://{parts.netloc}{target}'
+                headers.update(proxy_headers)
+            if offset: headers['Range'] = f'bytes={offset}-'
+            if offset and validator: headers['If-Range'] = validator
+            conn.request('GET', target, headers=headers)
+            response = conn.getresponse()
+            if response.status not in (301, 302, 303, 307, 308): return response
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+        raise IOError(f'too many redirects for {url}')
+    
+    def fetch(self, path, url, sha256=None):
+        # the ETag or Last-Modified date of the file a .part came from is kept
+        # next to it, and a .part is only resumed while the server still
+        # answers with that same file (If-Range), otherwise it starts over
+        part, validator_path = path + '.part', path + '.part.validator'
+        for attempt in range(self.retries):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            validator = None
+            if offset and os.path.exists(validator_path):
+                with open(validator_path, encoding='utf-8') as f: validator = f.read()
+            elif offset:
+                offset = 0 # nothing to tell whether it's still the same file
+            try:
+                with self.host(urlsplit(url).netloc).slots:
+                    response = self.request(url, offset, validator, fresh=attempt > 0)
+                    if response.status == 416: # nothing left after offset
+                        response.read()
+                        total = int(response.getheader('Content-Range', '*/-1').split('/')[-1])
+                        if total == offset: break
+                        os.remove(part)
+                        continue
+                    if response.status not in (200, 206):
+                        response.read()
+                        raise IOError(f'{url} answered {response.status} {response.reason}')
+                    if response.status == 206 and not response.getheader('Content-Range', '').startswith(f'bytes {offset}-'):
+                        response.read()
+                        os.remove(part)
+                        continue
+                    if response.status == 200: # the server ignored the Range, or the file changed
+                        offset = 0
+                        self.save_validator(validator_path, response)
+                    length = response.getheader('Content-Length')
+                    total = offset + int(length) if length is not None else None
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        while chunk := response.read(self.chunk): f.write(chunk)
+                if total is None or os.path.getsize(part) == total: break
+            except (OSError, HTTPException):
+                if attempt == self.retries - 1: raise
+        else:
+            raise IOError(f'{url} could not be downloaded completely')
+        if os.path.exists(validator_path): os.remove(validator_path)
+        if sha256 is not None and file_digest(part) != sha256:
+            os.remove(part)
+            raise IOError(f'{path} does not match its sha256 checksum')
+        os.replace(part, path)
+    
+    @staticmethod
+    def save_validator(validator_path, response):
+        etag = response.getheader('ETag')
+        validator = etag if etag and not etag.startswith('W/') else response.getheader('Last-Modified')
+        if validator:
+            with open(validator_path, 'w', encoding='utf-8') as f: f.write(validator)
+        elif os.path.exists(validator_path):
+            os.remove(validator_path) # If-Range needs a strong ETag or a date
+    
+    def get_files(self, files, workers=4):
+        '''
+        downloads every (path, url) or (path, url, sha256) in files whose
+        path doesn't exist yet, up to workers at a time
+        '''
+        def fetch(path, url, sha256=None):
+            t0 = time()
+            self.fetch(path, url, sha256)
+            print(f'downloading {path} :\t{time()-t0:.2f} seconds')
+        missing = [f for f in files if not os.path.exists(f[0])]
+        with ThreadPoolExecutor(max(1, min(workers, len(missing)))) as pool:
+            for future in [pool.submit(fetch, *f) for f in missing]: future.result()
+
+def get_files(files, workers=4):
+    Downloader().get_files(files, workers)
 
-def get_file(path, backup_url):
-    if not os.path.exists(path):
-        download_file(path, backup_url)
+def get_file(path, backup_url, sha256=None):
+    get_files([(path, backup_url, sha256)])
 
-def memoize(f):
-    memo = dict()
-    return lambda *X: memo[X] if X in memo else memo.setdefault(X, f(*X))
+def read_ahead(file, chunk=1 << 20, depth=8):
+    '''
+    yields the chunks of a binary file as a background thread reads them, at
+    most depth chunks ahead, so that reading (e.g. inflating a ZipFile member)
+    overlaps with whatever consumes them. The file must stay open until the
+    generator is exhausted or closed.
+    '''
+    chunks, stop = Queue(depth), Event()
+    def put(item):
+        # False once the consumer has stopped
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except Full: pass
+        return False
+    def reader():
+        try:
+            for data in iter(partial(file.read, chunk), b''):
+                if not put(data): return
+            put(None)
+        except BaseException as e:
+            put(e)
+    thread = Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while (data := chunks.get()) is not None:
+            if isinstance(data, BaseException): raise data
+            yield data
+    finally:
+        stop.set() # unblocks the reader if the consumer stopped early
+        thread.join()
 
-"""
-import types
-from zipfile import ZipExtFile
-def myreadline(*X,**Y):
-    # necessary to runtime-patch the ZipExtFile.readline method to repair a
-    # byte-reading error when sdmx.read_sdmx opens a (huge) zipped xml file
-    return ZipExtFile.readline(*X,**Y).decode('utf-8-sig')
-"""
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+def memoize(f=None, *, maxsize=128, disk=None):
+    '''
+    memoizes f, keeping at most maxsize results in memory (the least recently
+    used is evicted first, None keeps everything). Keyword arguments are part
+    of the key and unhashable arguments are keyed by their pickle. If disk is
+    a directory, results are also pickled there so they survive the process
+    (unless the arguments or the result can't be pickled).
+    The wrapper has cache_info() and cache_clear() (which leaves disk alone).
+    '''
+    if f is None: return partial(memoize, maxsize=maxsize, disk=disk)
+    memo = OrderedDict()
+    stats = {'hits': 0, 'misses': 0}
+    lock = Lock()
+    
+    def make_key(args, kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+            return key
+        except TypeError:
+            return pickle.dumps(key)
+    
+    def disk_path(key):
+        name = hashlib.sha256(key if isinstance(key, bytes) else pickle.dumps(key)).hexdigest()
+        return os.path.join(disk, f'{f.__module__}.{f.__qualname__}.{name[:32]}.pkl')
+    
+    @wraps(f)
+    def F(*args, **kwargs):
+        try:
+            key = make_key(args, kwargs)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return f(*args, **kwargs) # neither hashable nor picklable
+        with lock:
+            if key in memo:
+                stats['hits'] += 1
+                memo.move_to_end(key)
+                return memo[key]
+        path = None
+        if disk:
+            try: path = disk_path(key)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                pass # hashable but not picklable, so only cached in memory
+        if path and os.path.exists(path):
+            with open(path, 'rb') as file: value = pickle.load(file)
+            with lock: stats['hits'] += 1
+        else:
+            value = f(*args, **kwargs)
+            with lock: stats['misses'] += 1
+            if path:
+                ensure_dir(disk)
+                try:
+                    with open(path + '.tmp', 'wb') as file: pickle.dump(value, file)
+                    os.replace(path + '.tmp', path)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    os.remove(path + '.tmp') # not picklable, so only cached in memory
+        with lock:
+            memo[key] = value
+            if maxsize is not None and len(memo) > maxsize: memo.popitem(last=False)
+        return value
+    
+    def cache_info():
+        with lock: return CacheInfo(stats['hits'], stats['misses'], maxsize, len(memo))
+    def cache_clear():
+        with lock:
+            memo.clear()
+            stats.update(hits=0, misses=0)
+    F.cache_info, F.cache_clear = cache_info, cache_clear
+    return F
+
+# The heuristic to remember the USA (standard) cohorts is C[0] is total population,
+# C[18] is 85+ population, and C[i] for 0 < i < 18 is P(5(i-1),5i)
+age_to_cohort = lambda age: 1+int(age)//5
+
+@memoize(maxsize=None)
+def age_cohorts(label):
+    '''
+    range of the standard cohorts an age label covers, e.g. '0-4 years' and
+    'Under 5 years' -> [1], '15 to 24 years' -> [4, 5], '85 years and over'
+    -> [18], a label without ages (a total) -> [0, ..., 18]
+    '''
+    x = re.findall(r'\d+', label) + [False, False]
+    a = age_to_cohort(x[0]) if x[0] else 0
+    b = (age_to_cohort(x[1]) if x[1] else 18) + 1
+    y = re.match(r".*under.*?(\d+)", label, re.I)
+    if y: a,b = 1, age_to_cohort(y.group(1))
+    return range(a, b)
+
+def cohort_codes(labels):
+    '''the first cohort of every age label, parsing each distinct label once'''
+    codes, uniques = pd.factorize(np.asarray(labels))
+    return np.array([age_cohorts(label).start for label in uniques], dtype=np.intp)[codes]
 
 Ethnicity_to_race = {
     "European nfd":             'W',
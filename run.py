@@ -0,0 +1,124 @@
+"""
+@author: EAweblog
+
+Runs the pipelines of every country as one set of jobs: a job is a USA decade,
+a Canada census year or the NZ export, and its stages run in order
+(download -> load -> geos -> races -> CRR/ACE -> write). Every source file is
+downloaded once, however many jobs need it, and a job starts as soon as its
+files are there. Jobs run in parallel, each in a fresh process of its own, so
+the scripts' module-level state is never shared between jobs.
+
+    python run.py
+    python run.py --only usa canada --years 2016 2015 --jobs 3
+    python run.py --only nz --memory 4000 --force --parquet DATA.parquet
+    python run.py --only usa --memmap /var/tmp/fp
+
+--years picks the jobs that write any of those years, --memory caps the
+address space of every job (in MB, not on Windows), --memmap keeps the big
+USA value blocks in memory-mapped files (see helpers.value_block). Up-to-date
+jobs are skipped as usual (see helpers.Manifest) unless --force is given.
+"""
+
+import os
+import sys
+import argparse
+from time import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+from helpers import *
+
+# country: (script, {job: census years it writes}, how to run a job)
+countries = {
+    'usa':    ('assets-usa/cc-est-eval.py', {decade: range(decade, decade+10) for decade in (2000, 2010)},
+               lambda module, year, force: module.main2(year, force)),
+    'canada': ('assets-canada/VMAI-eval.py', {year: [year] for year in (2001, 2006, 2011, 2016)},
+               lambda module, year, force: module.main(years=(year,), workers=1, force=force)),
+    'nz':     ('assets-nz/dtr4-eval.py', {None: [2006, 2013, 2018]},
+               lambda module, year, force: module.main(force))}
+
+class Job(namedtuple('Job', ['country', 'year'])):
+    def __str__(self):
+        return self.country if self.year is None else f'{self.country} {self.year}'
+
+def select_jobs(only=None, years=None):
+    return [Job(country, year) for country in (only or countries)
+            for year, written in countries[country][1].items()
+            if not years or set(years) & set(written)]
+
+def load(country):
+    script = countries[country][0]
+    return load_script(os.path.join(here, script), country)
+
+def run_job(country, year, force=False, memory=None):
+    '''runs one job, in a worker process of its own'''
+    if memory and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory * 2**20, memory * 2**20))
+    script, _, run = countries[country]
+    os.chdir(os.path.join(here, os.path.dirname(script))) # the scripts work relative to their folder
+    t0 = time()
+    outputs = run(load(country), year, force)
+    return outputs, time() - t0
+
+def main(only=None, years=None, jobs=None, memory=None, force=False):
+    todo = select_jobs(only, years)
+    # the download tasks each job depends on, shared between jobs
+    needs = {}
+    for job in todo:
+        dirname = os.path.join(here, os.path.dirname(countries[job.country][0]))
+        sources = load(job.country).sources([job.year])
+        needs[job] = {(os.path.join(dirname, path), url) for path, url in sources}
+    downloader = Downloader()
+    failed = []
+    with ThreadPoolExecutor(4) as downloads, ProcessPoolExecutor(jobs, max_tasks_per_child=1) as pool:
+        fetching = {}
+        for path, url in set().union(*needs.values()):
+            ensure_dir(os.path.dirname(path))
+            fetching[downloads.submit(downloader.get_files, [(path, url)])] = path
+        fetched = set()
+        running = {}
+        while todo or running:
+            for job in [job for job in todo if {path for path, _ in needs[job]} <= fetched]:
+                todo.remove(job)
+                running[pool.submit(run_job, job.country, job.year, force, memory)] = job
+            done, _ = wait([*fetching, *running], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in fetching:
+                    path = fetching.pop(future)
+                    if future.exception() is None:
+                        fetched.add(path)
+                        continue
+                    print(f'downloading {path} failed: {future.exception()!r}')
+                    for job in [job for job in todo if path in {p for p, _ in needs[job]}]:
+                        todo.remove(job)
+                        failed.append(job)
+                else:
+                    job = running.pop(future)
+                    try:
+                        outputs, seconds = future.result()
+                        print(f'{job} :\t{"up to date" if not outputs else f"{seconds:.2f} seconds"}')
+                    except Exception as e:
+                        print(f'{job} failed: {e!r}')
+                        failed.append(job)
+    if profile_settings['path']: profile_summary()
+    if failed: sys.exit('failed: ' + ', '.join(map(str, failed)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run the pipelines of every country')
+    parser.add_argument('--only', nargs='+', choices=list(countries), help='countries to run')
+    parser.add_argument('--years', nargs='+', type=int, help='run the jobs that write any of these years')
+    parser.add_argument('--jobs', type=int, default=None, help='jobs running at once')
+    parser.add_argument('--memory', type=int, default=None, help='address space limit of every job in MB')
+    parser.add_argument('--force', action='store_true', help='rebuild jobs even if their inputs are unchanged')
+    parser.add_argument('--parquet', help='also write to this parquet dataset, partitioned by country and year')
+    parser.add_argument('--memmap', help='keep the USA value blocks as memory-mapped files in this folder')
+    args = parser.parse_args()
+    # the jobs' processes pick these up from the environment, and run from other folders
+    if args.parquet: os.environ['FP_PARQUET'] = os.path.abspath(args.parquet)
+    if args.memmap: os.environ['FP_MEMMAP'] = os.path.abspath(args.memmap)
+    if profile_settings['path']:
+        os.environ['FP_PROFILE'] = os.path.abspath(profile_settings['path'])
+        profile_to(os.environ['FP_PROFILE'], profile_settings['tracemalloc'])
+    main(args.only, args.years, args.jobs, args.memory, args.force)